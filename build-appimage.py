@@ -1,17 +1,136 @@
 #!/usr/bin/env python3
 import argparse
+import fcntl
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
 import logging
 import logging.config
 import logging.handlers
+import mmap
 import os
+import platform
+import re
+import resource
 import shutil
+import statistics
+import struct
 import subprocess
 import sys
+import tarfile
+import threading
+import time
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Union
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, Union
 
 PROJECT_DIR = Path().absolute()
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser().joinpath('python-appimage')
+DEFAULT_CACHE_SIZE = 10240  # MiB
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar.xz')
+# Top-level directories of the source trees the build never reads.
+SOURCE_EXCLUDES = {
+    'cpython': ('Doc', 'Mac'),
+    'openssl': (),
+    'sqlite': (),
+}
+MANIFEST_PATH = Path('usr', 'local', 'share', 'python-appimage', 'manifest.json')
+BUILD_PROFILES = {
+    'debug': ('--with-pydebug',),
+    'release': (),
+    'optimized': ('--enable-optimizations', '--with-lto'),
+}
+DEFAULT_BUILD_PROFILE = 'release'
+# Compile time options of sqlite, without the SQLITE_ prefix as PRAGMA compile_options reports them.
+SQLITE_PROFILES = {
+    'stock': {'options': (), 'cflags': ()},
+    'general': {
+        'options': ('ENABLE_FTS5', 'DEFAULT_WAL_SYNCHRONOUS=1', 'THREADSAFE=1'),
+        'cflags': ('-O2',),
+    },
+    'analytics': {
+        'options': ('ENABLE_FTS5', 'ENABLE_STAT4', 'DEFAULT_WAL_SYNCHRONOUS=1', 'THREADSAFE=1',
+                    'DEFAULT_CACHE_SIZE=-65536', 'DEFAULT_MMAP_SIZE=268435456'),
+        'cflags': ('-O3',),
+    },
+}
+# sqlite's own defaults, the other profiles change the runtime defaults of every connection.
+DEFAULT_SQLITE_PROFILE = 'stock'
+# Static libraries without tests, engines or protocols the ssl module never uses, with the fast 64-bit NIST curves.
+OPENSSL_OPTIONS = ('no-shared', '-fPIC', 'no-tests', 'enable-ec_nistp_64_gcc_128',
+                   'no-ssl3', 'no-dtls', 'no-comp', 'no-weak-ssl-ciphers',
+                   'no-afalgeng', 'no-capieng', 'no-padlockeng')
+# openssl speed invocations compared with --openssl-speed, each measuring one algorithm.
+OPENSSL_SPEED_TESTS = {
+    'aes-128-gcm': '-bytes 16384 -evp aes-128-gcm',
+    'chacha20-poly1305': '-bytes 16384 -evp chacha20-poly1305',
+    'sha256': '-bytes 16384 -evp sha256',
+    'ecdhp256': 'ecdhp256',
+}
+
+DEFAULT_LOG_TAIL = 40  # lines
+INVALIDATION_MODES = ('timestamp', 'checked-hash', 'unchecked-hash')
+DEFAULT_INVALIDATION_MODE = 'unchecked-hash'
+# Test data cpython deliberately ships with invalid syntax, as excluded by its own Makefile.
+BYTECODE_EXCLUDE = r'bad_coding|badsyntax|lib2to3/tests/data'
+# Stdlib entries that stay on disk in a zipped stdlib, besides packages shipping data files.
+# os.py is the landmark the interpreter searches for to find its prefix.
+ZIP_STDLIB_KEEP = ('__pycache__', 'lib-dynload', 'os.py', 'pydoc.py', 'site-packages', 'test')
+STARTUP_PROBE = ('import json, os, sys, ssl, sqlite3; '
+                 'origins = [getattr(m.__spec__, "origin", None) or "" for m in list(sys.modules.values()) '
+                 'if getattr(m, "__spec__", None)]; '
+                 'print(json.dumps({"modules": len(origins), '
+                 '"from_zip": sum(".zip" + os.sep in o for o in origins), '
+                 '"from_disk": sum(os.path.isabs(o) and ".zip" + os.sep not in o for o in origins)}))')
+
+# regrtest modules and pytest arguments of the verify stage. The AppRun tests need the packed image, and the
+# *_tests_work tests run regrtest modules one at a time, which the stage already runs in parallel.
+VERIFY_TESTS = ('test_ssl', 'test_sqlite', 'test_hashlib', 'test_curses')
+VERIFY_PYTEST_ARGS = "--ignore=test_apprun.py -k 'not tests_work'"
+VERIFY_SLOWEST = 10
+
+# Codecs limited to those the type 2 AppImage runtime can mount.
+COMPRESSION_PROFILES = {
+    'fast-start': {'compression': 'zstd', 'block_size': 65536, 'options': ('-Xcompression-level', '3')},
+    'balanced': {'compression': 'zstd', 'block_size': 262144, 'options': ('-Xcompression-level', '15')},
+    'smallest': {'compression': 'xz', 'block_size': 1048576, 'options': ('-Xbcj', 'x86')},
+}
+DEFAULT_COMPRESSION_PROFILE = 'fast-start'
+FULL_READ_PROBE = ('import os, sys\n'
+                   'for root, dirs, files in os.walk(sys.prefix):\n'
+                   '    for name in files:\n'
+                   '        path = os.path.join(root, name)\n'
+                   '        if not os.path.islink(path):\n'
+                   '            with open(path, "rb") as f:\n'
+                   '                while f.read(1 << 20):\n'
+                   '                    pass\n')
+
+# Library directories of the AppDir, as set up by AppRun.
+APP_DIR_LIBRARY_DIRS = ('usr/local/sqlite3/lib', 'usr/lib')
+DEFAULT_LIBRARY_DIRS = ('/lib64', '/usr/lib64', '/lib/x86_64-linux-gnu', '/usr/lib/x86_64-linux-gnu',
+                        '/lib', '/usr/lib')
+# Libraries every target system provides, which must come from the host, after the AppImage excludelist.
+SYSTEM_LIBRARY_EXCLUDES = (
+    'ld-linux*.so*', 'libc.so.*', 'libm.so.*', 'libmvec.so.*', 'libdl.so.*', 'libpthread.so.*', 'librt.so.*',
+    'libresolv.so.*', 'libutil.so.*', 'libnsl.so.*', 'libanl.so.*', 'libnss_*.so.*', 'libBrokenLocale.so.*',
+    'libthread_db.so.*', 'libgcc_s.so.*', 'libstdc++.so.*', 'libz.so.*', 'libuuid.so.*', 'libexpat.so.*',
+)
+
+_manifest_lock = threading.Lock()
+_command_log_dir = None
+_command_log_tail = DEFAULT_LOG_TAIL
+_jobserver = None
+_jobserver_reader = None
+_jobserver_jobs = os.cpu_count() or 1
 
 
 class AppImageError(Exception):
@@ -19,32 +138,679 @@ class AppImageError(Exception):
     pass
 
 
+@dataclass
+class Stage:
+    """A build stage and the names of the stages it depends on.
+
+    ``function`` is called with a dictionary mapping every dependency name to
+    the value its function returned.
+    """
+    name: str
+    function: Callable[[Dict[str, Any]], Any]
+    dependencies: Tuple[str, ...] = ()
+    started: float = field(default=0.0, repr=False)
+    finished: float = field(default=0.0, repr=False)
+    span: Union[dict, None] = field(default=None, repr=False)
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+@dataclass(frozen=True)
+class ElfDynamic:
+    """Dynamic linking details of an ELF file."""
+    elf_class: int
+    machine: int
+    needed: Tuple[str, ...] = ()
+    rpath: Tuple[str, ...] = ()
+    runpath: Tuple[str, ...] = ()
+
+
+@dataclass
+class BuildTree:
+    """Where the stages unpack and build their sources.
+
+    A persistent tree keeps unpacked and configured sources between runs.
+    ``exports`` is prefixed to the configure and make commands, to route
+    compiles through a compiler cache. Tarballs are only unpacked when a
+    stage misses the artifact cache, see extract and speculate.
+    """
+    root: Path
+    persistent: bool = False
+    exports: str = ''
+    _extractions: dict = field(default_factory=dict, repr=False)
+    _speculative: list = field(default_factory=list, repr=False)
+    _executor: Union[ThreadPoolExecutor, None] = field(default=None, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def source_directory(self, source_file: Path) -> Path:
+        """Return the directory a source tarball is unpacked into."""
+        return self.root.joinpath(f'{strip_archive_suffix(source_file.name)}-{get_file_digest(source_file)[:12]}')
+
+    def extract(self, source_file: Path, exclude: Iterable[str] = ()) -> Future:
+        """Start unpacking a source tarball in the background, at most once per tarball.
+
+        In a persistent tree a tarball already unpacked by an earlier run is
+        reused as it is. The first extraction also starts unpacking the
+        tarballs passed to speculate.
+
+        :param source_file: Source tarball
+        :type source_file: Path
+        :param exclude: Top-level directories of the tree to skip
+        :type exclude: Iterable[str]
+        :returns: Future resolving to the directory the tarball was unpacked into
+        :rtype: Future
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix='extract')
+            for _source_file, _exclude in [(source_file, tuple(exclude)), *self._speculative]:
+                if _source_file not in self._extractions:
+                    self._extractions[_source_file] = self._executor.submit(self._extract, _source_file, _exclude)
+            self._speculative.clear()
+            return self._extractions[source_file]
+
+    def speculate(self, source_file: Path, exclude: Iterable[str] = ()) -> None:
+        """Unpack a source tarball in the background as soon as any other tarball is unpacked.
+
+        A stage building from source is likely followed by stages that miss
+        the cache too, e.g. cpython after rebuilding sqlite, so their
+        tarballs unpack while it builds. When every stage is restored from
+        the cache nothing is unpacked.
+
+        :param source_file: Source tarball
+        :type source_file: Path
+        :param exclude: Top-level directories of the tree to skip
+        :type exclude: Iterable[str]
+        """
+        with self._lock:
+            if source_file not in self._extractions:
+                self._speculative.append((source_file, tuple(exclude)))
+
+    def _extract(self, source_file: Path, exclude: tuple) -> Path:
+        directory = self.source_directory(source_file)
+        marker = directory.joinpath('.appimage-unpacked')
+        if self.persistent and marker.exists():
+            logging.debug(f'Reusing unpacked {source_file.name} in {directory}')
+            return directory
+        if directory.exists():
+            shutil.rmtree(directory)
+        directory.mkdir(parents=True)
+        extract_archive(source_file, directory, exclude)
+        marker.touch()
+        return directory
+
+    def shutdown(self) -> None:
+        """Cancel pending background extractions and wait for the running ones.
+
+        The work directory may be removed next, so running extractions are
+        not abandoned.
+        """
+        with self._lock:
+            self._speculative.clear()
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+
+class BuildTimeline:
+    """Nested timeline of timed build steps.
+
+    Every span records its wall clock offsets relative to the start of the
+    timeline, and the user and system CPU time consumed by child processes
+    reaped while it was open, from ``getrusage(RUSAGE_CHILDREN)``. Children
+    are accounted process-wide, so spans running concurrently in other
+    threads each include the CPU time of the others' children. The peak RSS
+    is the largest resident set of any child reaped so far.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Union[dict, None]:
+        """Return the innermost open span of the calling thread."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name: str, kind: str = 'step', parent: Union[dict, None] = None) -> Iterator[dict]:
+        """Time the body of the with statement as a span.
+
+        :param name: Name of the span
+        :type name: str
+        :param kind: Kind of the span, e.g. stage, step or command
+        :type kind: str
+        :param parent: Span to nest below, defaults to the innermost open span of this thread
+        :type parent: Union[dict, None]
+        :returns: The span record, completed when the with statement exits
+        :rtype: Iterator[dict]
+        """
+        stack = self._stack()
+        parent = parent if parent is not None else self.current()
+        record = {
+            'name': name,
+            'kind': kind,
+            'thread': threading.current_thread().name,
+            'start': round(time.perf_counter() - self.started, 3),
+            'children': [],
+        }
+        with self._lock:
+            (parent['children'] if parent is not None else self.spans).append(record)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stack.append(record)
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            stack.remove(record)
+            end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['duration'] = round(time.perf_counter() - self.started - record['start'], 3)
+            record['child_user_cpu'] = round(end_usage.ru_utime - usage.ru_utime, 3)
+            record['child_system_cpu'] = round(end_usage.ru_stime - usage.ru_stime, 3)
+            record['child_max_rss_kb'] = end_usage.ru_maxrss
+
+
+TIMELINE = BuildTimeline()
+
+
+def timed(function: Callable) -> Callable:
+    """Decorator recording every call of a function as a timeline span."""
+    @functools.wraps(function)
+    def _wrapper(*args, **kwargs):
+        with TIMELINE.span(function.__name__):
+            return function(*args, **kwargs)
+    return _wrapper
+
+
+class ArtifactCache:
+    """Content-addressed cache of installed stage prefixes.
+
+    Every entry is an uncompressed tarball of the prefixes a stage installs
+    into the AppDir, plus a JSON sidecar holding the stage metadata. Entries
+    are written to a temporary name and renamed into place, so several
+    builders may share one cache directory. Eviction is least-recently-used,
+    based on the modification time which is refreshed on every hit, and is
+    serialized between processes with an exclusive lock.
+    """
+
+    def __init__(self, directory: Path, max_size: int):
+        """
+        :param directory: Directory holding the cache entries
+        :type directory: Path
+        :param max_size: Maximum size of the cache in bytes
+        :type max_size: int
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, key: str) -> tuple:
+        return self.directory.joinpath(f'{key}.tar'), self.directory.joinpath(f'{key}.json')
+
+    def restore(self, key: str, app_dir: Path, exclude: Iterable[str] = ()) -> Union[dict, None]:
+        """Unpack a cached artifact into the AppDir.
+
+        :param key: Cache key of the artifact
+        :type key: str
+        :param app_dir: Base AppDir directory
+        :type app_dir: Path
+        :param exclude: Paths, relative to the AppDir, not to restore, also from entries stored with them
+        :type exclude: Iterable[str]
+        :returns: Metadata stored with the artifact, or None on a miss
+        :rtype: Union[dict, None]
+        """
+        archive, metadata_file = self._paths(key)
+        try:
+            # Keep the handles open, a concurrent eviction only unlinks the names.
+            with metadata_file.open() as _metadata, tarfile.open(archive, mode='r:') as _tar:
+                metadata = json.load(_metadata)
+                logging.debug(f'Cache hit for {key}, restoring into {app_dir}')
+                members = [_member for _member in _tar if not is_excluded(_member.name, exclude)]
+                if hasattr(tarfile, 'tar_filter'):
+                    _tar.extractall(app_dir, members=members, filter='tar')
+                else:
+                    _tar.extractall(app_dir, members=members)
+        except FileNotFoundError:
+            logging.debug(f'Cache miss for {key}')
+            return None
+        except (OSError, tarfile.TarError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable cache entry {key}: {e}')
+            return None
+
+        now = time.time()
+        for _path in (archive, metadata_file):
+            try:
+                os.utime(_path, (now, now))
+            except FileNotFoundError:
+                pass
+        return metadata
+
+    def store(self,
+              key: str,
+              app_dir: Path,
+              prefixes: Iterable[str],
+              metadata: dict,
+              exclude: Iterable[str] = ()) -> None:
+        """Archive the installed prefixes of a stage into the cache.
+
+        :param key: Cache key of the artifact
+        :type key: str
+        :param app_dir: Base AppDir directory
+        :type app_dir: Path
+        :param prefixes: Prefixes, relative to the AppDir, installed by the stage
+        :type prefixes: Iterable[str]
+        :param metadata: Stage metadata to return on a later hit
+        :type metadata: dict
+        :param exclude: Paths below the prefixes, relative to the AppDir, not to archive
+        :type exclude: Iterable[str]
+        """
+        exclude = tuple(exclude)
+        archive, metadata_file = self._paths(key)
+        suffix = f'.tmp-{os.getpid()}-{threading.get_ident()}'
+        tmp_archive = archive.with_name(archive.name + suffix)
+        tmp_metadata = metadata_file.with_name(metadata_file.name + suffix)
+        try:
+            with tarfile.open(tmp_archive, mode='w:') as _tar:
+                for _prefix in prefixes:
+                    if app_dir.joinpath(_prefix).exists():
+                        _tar.add(app_dir.joinpath(_prefix), arcname=_prefix,
+                                 filter=lambda _info: None if is_excluded(_info.name, exclude) else _info)
+            with tmp_metadata.open(mode='w') as _out:
+                json.dump(metadata, _out)
+            # The archive must be in place before the metadata makes it visible.
+            os.replace(tmp_archive, archive)
+            os.replace(tmp_metadata, metadata_file)
+        except OSError as e:
+            logging.warning(f'Could not store {key} in cache: {e}')
+            return
+        finally:
+            tmp_archive.unlink(missing_ok=True)
+            tmp_metadata.unlink(missing_ok=True)
+        logging.debug(f'Stored {key} in cache')
+        self.evict()
+
+    def load_measurements(self, name: str) -> Union[dict, None]:
+        """Return the measurements an earlier build recorded under a name.
+
+        :param name: Name of the measurements
+        :type name: str
+        :returns: Recorded measurements, or None when there are none
+        :rtype: Union[dict, None]
+        """
+        try:
+            with self.directory.joinpath('measurements', f'{name}.json').open() as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable measurements {name}: {e}')
+            return None
+
+    def store_measurements(self, name: str, measurements: dict) -> None:
+        """Record measurements for later builds to compare with, replacing earlier ones.
+
+        Measurements are kept beside the cache entries and are never evicted.
+
+        :param name: Name of the measurements
+        :type name: str
+        :param measurements: Measurements to record
+        :type measurements: dict
+        """
+        measurements_file = self.directory.joinpath('measurements', f'{name}.json')
+        tmp_file = measurements_file.with_name(f'{measurements_file.name}.tmp-{os.getpid()}-{threading.get_ident()}')
+        try:
+            measurements_file.parent.mkdir(exist_ok=True)
+            with tmp_file.open(mode='w') as _out:
+                json.dump(measurements, _out)
+            os.replace(tmp_file, measurements_file)
+        except OSError as e:
+            logging.warning(f'Could not record measurements {name}: {e}')
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits its size."""
+        with self.directory.joinpath('.lock').open(mode='w') as _lock:
+            fcntl.flock(_lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for _archive in self.directory.glob('*.tar'):
+                try:
+                    stat = _archive.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, _archive))
+                total += stat.st_size
+
+            for _mtime, _size, _archive in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logging.debug(f'Evicting {_archive.stem} from cache')
+                _archive.with_suffix('.json').unlink(missing_ok=True)
+                _archive.unlink(missing_ok=True)
+                total -= _size
+
+
+def is_excluded(name: str, exclude: Iterable[str]) -> bool:
+    """Return whether a relative path is one of the excluded paths or below one."""
+    return any(name == _path or name.startswith(f'{_path}/') for _path in exclude)
+
+
 def main():
     args = get_args()
     args.source_dir = Path(args.source_dir).expanduser().absolute()
     args.resources_dir = Path(args.resources_dir).expanduser().absolute()
+    if args.prune_manifest is None:
+        args.prune_manifest = args.resources_dir.joinpath('prune.json')
+    args.prune_manifest = Path(args.prune_manifest).expanduser().absolute()
+    args.wheelhouse = Path(args.wheelhouse).expanduser().absolute()
+    args.verify_results = Path(args.verify_results).expanduser().absolute()
+    if args.wheelhouse_requirements:
+        args.wheelhouse_requirements = Path(args.wheelhouse_requirements).expanduser().absolute()
     configure_logging(verbosity=args.verbosity)
+    configure_command_logs(Path(args.log_dir).expanduser().absolute(), tail=args.log_tail)
+
+    configure_jobserver(args.jobs)
 
     source_config = get_source_configs(args.source_dir)
-    if source_config['cpython']['source_path'] is None:
+    if not source_config['cpython']:
         logging.critical(f'cpython source not found in {args.source_dir}')
         sys.exit(1)
 
-    with TemporaryDirectory() as work_dir:
-        app_dir = Path(work_dir, 'AppDir')
-        logging.debug(f'Temp directory is {app_dir}')
-        build_app_dir(app_dir)
+    cache = None
+    if not args.no_cache:
+        cache = ArtifactCache(Path(args.cache_dir).expanduser().absolute(), args.cache_size * 1024 * 1024)
+
+    with work_directory(args.work_dir) as work_dir:
+        # sqlite and openssl are installed here once and copied into the AppDir of every interpreter.
+        deps_dir = work_dir.joinpath('deps')
+        tree = BuildTree(work_dir.joinpath('src'),
+                         persistent=args.work_dir is not None,
+                         exports='' if args.no_ccache else get_ccache_exports(work_dir))
+        # Unpack cpython's tarballs while sqlite or openssl build, if either misses the cache.
+        for _config in source_config['cpython']:
+            tree.speculate(_config['source_path'], SOURCE_EXCLUDES['cpython'])
+        stages = [
+            Stage('sqlite', lambda _: configure_sqlite(source_config['sqlite'], deps_dir, cache=cache, tree=tree,
+                                                       profile=args.sqlite_profile)),
+            Stage('openssl', lambda _: configure_openssl(source_config['openssl'], deps_dir, cache=cache, tree=tree,
+                                                         options=args.openssl_options.split(),
+                                                         speed=args.openssl_speed)),
+        ]
+        for _config in source_config['cpython']:
+            app_dir = work_dir.joinpath('AppDir', _config['version'])
+            logging.debug(f'AppDir of cpython {_config["version"]} is {app_dir}')
+            build_app_dir(app_dir)
+            stages.extend(get_interpreter_stages(args, _config, app_dir, deps_dir, cache, tree))
         try:
-            configure_sqlite(source_config['sqlite'], app_dir)
-            configure_openssl(source_config['openssl'], app_dir)
-            python_version = configure_python(source_config['cpython'], app_dir)
-            add_venv_module(app_dir, args.source_dir, python_version)
-            build_app_image(app_dir, args.resources_dir)
+            with TIMELINE.span('build', kind='build'):
+                run_stages(stages)
         except AppImageError as e:
             logging.critical(e)
             sys.exit(2)
+        finally:
+            tree.shutdown()
+            log_build_summary(stages)
+            if args.report:
+                write_build_report(Path(args.report).expanduser().absolute(), stages)
+
+
+def get_interpreter_stages(args: argparse.Namespace,
+                           python_config: dict,
+                           app_dir: Path,
+                           deps_dir: Path,
+                           cache: Union[ArtifactCache, None],
+                           tree: BuildTree) -> list:
+    """Return the stages building the AppImage of one cpython source.
+
+    Stage names end with the version of the source, so the stages of
+    several interpreters run side by side, all depending on the same sqlite
+    and openssl stages.
+
+    :param args: Parsed command line arguments
+    :type args: argparse.Namespace
+    :param python_config: Dictionary of python config
+    :type python_config: dict
+    :param app_dir: AppDir of this interpreter
+    :type app_dir: Path
+    :param deps_dir: Directory sqlite and openssl are installed into
+    :type deps_dir: Path
+    :param cache: Artifact cache, or None to always build
+    :type cache: Union[ArtifactCache, None]
+    :param tree: Where to unpack and build
+    :type tree: BuildTree
+    :returns: Stages of the interpreter
+    :rtype: list
+    """
+    suffix = f'-{python_config["version"]}'
+    cpython = f'cpython{suffix}'
+    stages = [
+        Stage(cpython,
+              lambda deps: configure_python(python_config, app_dir, cache=cache,
+                                            dependencies=(deps['sqlite'], deps['openssl']),
+                                            profile=args.profile, pgo_task=args.pgo_task, tree=tree,
+                                            deps_dir=deps_dir),
+              ('sqlite', 'openssl')),
+        Stage(f'appimage_venv{suffix}',
+              lambda deps: add_venv_module(app_dir, args.source_dir, deps[cpython]),
+              (cpython,)),
+    ]
+    if args.wheelhouse_requirements:
+        stages.append(Stage(f'wheelhouse{suffix}',
+                            lambda deps: build_wheelhouse(app_dir, deps[cpython],
+                                                          args.wheelhouse_requirements, args.wheelhouse),
+                            (cpython,)))
+    stages.append(Stage(f'bytecode{suffix}',
+                        lambda deps: compile_bytecode(app_dir, deps[cpython],
+                                                      invalidation_mode=args.invalidation_mode),
+                        (cpython,) + tuple(_stage.name for _stage in stages[1:])))
+    if args.verify:
+        # Before prune, which removes the stdlib test suite.
+        stages.append(Stage(f'verify{suffix}',
+                            lambda deps: verify_app_dir(app_dir, deps[cpython],
+                                                        args.verify_results.joinpath(python_config['version']),
+                                                        tests=args.verify_tests.split(),
+                                                        pytest_args=args.verify_pytest_args,
+                                                        wheelhouse=args.wheelhouse),
+                            (cpython, stages[-1].name)))
+    if not args.no_prune:
+        stages.append(Stage(f'prune{suffix}', lambda _: prune_app_dir(app_dir, args.prune_manifest),
+                            (stages[-1].name,)))
+    if args.zip_stdlib:
+        # After prune, which only removes files still on disk.
+        stages.append(Stage(f'stdlib_zip{suffix}', lambda deps: zip_stdlib(app_dir, deps[cpython]),
+                            (cpython, stages[-1].name)))
+    stages.append(Stage(f'appimage{suffix}',
+                        lambda deps: build_app_image(app_dir, args.resources_dir, deps[cpython],
+                                                     compression=args.compression,
+                                                     compare_compression=args.compare_compression,
+                                                     deps_dir=deps_dir),
+                        (cpython, stages[-1].name)))
+    return stages
+
+
+@contextmanager
+def work_directory(directory: Union[str, None]) -> Iterator[Path]:
+    """Yield the directory holding the AppDir and the build trees.
+
+    A given directory is kept between runs, only the AppDirs and the
+    installed dependencies are rebuilt from scratch. Without one a temporary
+    directory is used and removed.
+
+    :param directory: Persistent work directory, or None
+    :type directory: Union[str, None]
+    :returns: Absolute path of the work directory
+    :rtype: Iterator[Path]
+    """
+    if directory is None:
+        with TemporaryDirectory() as _tmp:
+            yield Path(_tmp)
+        return
+
+    work_dir = Path(directory).expanduser().absolute()
+    for _name in ('AppDir', 'deps'):
+        if work_dir.joinpath(_name).exists():
+            shutil.rmtree(work_dir.joinpath(_name))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    yield work_dir
+
+
+def run_stages(stages: Iterable[Stage], max_workers: Union[int, None] = None) -> Dict[str, Any]:
+    """Run stages concurrently, each as soon as its dependencies finished.
+
+    The first failing stage stops any further stage from being started, the
+    ones already running are waited for and its exception is re-raised.
+
+    :param stages: Stages to run
+    :type stages: Iterable[Stage]
+    :param max_workers: Maximum number of stages running at once, defaults to all
+    :type max_workers: Union[int, None]
+    :returns: Dictionary of stage names to the values returned by the stages
+    :rtype: Dict[str, Any]
+    :raises AppImageError: A dependency is unknown or cyclic, or a stage failed
+    """
+    pending = {_stage.name: _stage for _stage in stages}
+    for _stage in pending.values():
+        for _dependency in _stage.dependencies:
+            if _dependency not in pending:
+                raise AppImageError(f'Stage {_stage.name} depends on unknown stage {_dependency}.')
 
+    parent = TIMELINE.current()
 
+    def _run(stage: Stage, dependencies: Dict[str, Any]) -> Any:
+        threading.current_thread().name = stage.name
+        stage.started = time.perf_counter()
+        try:
+            with TIMELINE.span(stage.name, kind='stage', parent=parent) as stage.span:
+                return stage.function(dependencies)
+        finally:
+            stage.finished = time.perf_counter()
+
+    results = {}
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(pending) or 1) as executor:
+        while pending or running:
+            if error is None:
+                for _name, _stage in list(pending.items()):
+                    if all(_dependency in results for _dependency in _stage.dependencies):
+                        logging.debug(f'Starting stage {_name}')
+                        dependencies = {_dependency: results[_dependency] for _dependency in _stage.dependencies}
+                        running[executor.submit(_run, _stage, dependencies)] = _name
+                        del pending[_name]
+            if not running:
+                if error is None:
+                    raise AppImageError(f'Stages {", ".join(pending)} have cyclic dependencies.')
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for _future in done:
+                _name = running.pop(_future)
+                try:
+                    results[_name] = _future.result()
+                except Exception as e:
+                    logging.debug(f'Stage {_name} failed')
+                    error = error or e
+
+    if error is not None:
+        raise error
+    return results
+
+
+def get_critical_path(stages: Iterable[Stage]) -> Tuple[list, float]:
+    """Return the chain of dependent stages with the longest total duration.
+
+    :param stages: Stages that have been run
+    :type stages: Iterable[Stage]
+    :returns: Stage names along the critical path and its total duration
+    :rtype: Tuple[list, float]
+    """
+    stages = {_stage.name: _stage for _stage in stages}
+
+    @functools.lru_cache(maxsize=None)
+    def _longest(name: str) -> Tuple[tuple, float]:
+        stage = stages[name]
+        path, duration = (), 0.0
+        for _dependency in stage.dependencies:
+            if _dependency not in stages:
+                continue
+            _path, _duration = _longest(_dependency)
+            if _duration > duration:
+                path, duration = _path, _duration
+        return path + (name,), duration + stage.duration
+
+    if not stages:
+        return [], 0.0
+    path, duration = max((_longest(_name) for _name in stages), key=lambda _item: _item[1])
+    return list(path), duration
+
+
+def log_build_summary(stages: Iterable[Stage]) -> None:
+    """Log a table of the stages that have been run and the critical path.
+
+    :param stages: Stages to report on
+    :type stages: Iterable[Stage]
+    """
+    stages = [_stage for _stage in stages if _stage.finished]
+    if not stages:
+        return
+    width = max(16, *(len(_stage.name) for _stage in stages))
+    logging.info(f'{"stage":<{width}} {"wall":>9} {"child cpu":>10} {"peak rss":>10}')
+    for _stage in stages:
+        cpu = _stage.span['child_user_cpu'] + _stage.span['child_system_cpu']
+        rss = _stage.span['child_max_rss_kb'] / 1024
+        status = ' failed' if _stage.span.get('failed') else ''
+        logging.info(f'{_stage.name:<{width}} {_stage.duration:8.1f}s {cpu:9.1f}s {rss:7.0f}MiB{status}')
+    path, duration = get_critical_path(stages)
+    wall = max(_stage.finished for _stage in stages) - min(_stage.started for _stage in stages)
+    logging.info(f'Critical path {" -> ".join(path)}: {duration:.1f}s of {wall:.1f}s wall clock')
+
+
+def write_build_report(report_file: Path, stages: Iterable[Stage]) -> None:
+    """Write the timeline of the build as a JSON report.
+
+    :param report_file: File to write the report to
+    :type report_file: Path
+    :param stages: Stages of the build
+    :type stages: Iterable[Stage]
+    """
+    stages = [_stage for _stage in stages if _stage.finished]
+    path, duration = get_critical_path(stages)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report = {
+        'format': 1,
+        'started_at': TIMELINE.started_at.isoformat(),
+        'wall_time': round(time.perf_counter() - TIMELINE.started, 3),
+        'child_user_cpu': round(usage.ru_utime, 3),
+        'child_system_cpu': round(usage.ru_stime, 3),
+        'child_max_rss_kb': usage.ru_maxrss,
+        'critical_path': {'stages': path, 'duration': round(duration, 3)},
+        'stages': {
+            _stage.name: {
+                'duration': round(_stage.duration, 3),
+                'dependencies': list(_stage.dependencies),
+                'failed': bool(_stage.span.get('failed')),
+            } for _stage in stages
+        },
+        'timeline': TIMELINE.spans,
+    }
+    logging.info(f'Writing build report to {report_file}')
+    with report_file.open(mode='w') as f:
+        json.dump(report, f, indent=2)
+
+
+@timed
 def add_venv_module(app_dir: Path, source_dir: Path, version: str) -> None:
     """Copy venv module into the base python.
 
@@ -56,30 +822,415 @@ def add_venv_module(app_dir: Path, source_dir: Path, version: str) -> None:
     :type version: str
     :raises AppImageError: Copying failed
     """
-    release = '.'.join(version.split('.')[:2])
-    module_dir = app_dir.joinpath('usr', 'local', 'lib', f'python{release}', 'appimage_venv')
+    module_dir = get_python_lib_dir(app_dir, version).joinpath('appimage_venv')
     logging.debug(f'Copying appimage_venv module to {module_dir}')
     try:
         shutil.copytree(source_dir.joinpath('appimage_venv'), module_dir)
-        make_readable(module_dir)
-    except (shutil.Error, AppImageError) as e:
+    except shutil.Error as e:
         raise(AppImageError(e))
 
 
+@timed
+def build_wheelhouse(app_dir: Path, version: str, requirements: Path, wheelhouse: Path) -> None:
+    """Build wheels of a requirements file with the python installed into the AppDir.
+
+    Wheels already in the wheelhouse are reused. The location is recorded in
+    the manifest, where appimage_venv picks it up as pip's find-links.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :param requirements: Requirements file
+    :type requirements: Path
+    :param wheelhouse: Directory to build the wheels into
+    :type wheelhouse: Path
+    :raises AppImageError: Building a wheel failed
+    """
+    logging.info(f'Building wheelhouse from {requirements.name}.')
+    wheelhouse.mkdir(parents=True, exist_ok=True)
+    run_command(f"PYTHONDONTWRITEBYTECODE=1 {get_python_command(app_dir, version)} -m pip wheel \
+                  --disable-pip-version-check \
+                  --wheel-dir '{wheelhouse}' \
+                  --find-links '{wheelhouse}' \
+                  --requirement '{requirements}'")
+    update_build_manifest(app_dir, 'wheelhouse', {
+        'path': str(wheelhouse),
+        'requirements': str(requirements),
+        'wheels': sorted(_wheel.name for _wheel in wheelhouse.glob('*.whl')),
+    })
+
+
+@timed
+def verify_app_dir(app_dir: Path,
+                   version: str,
+                   results_dir: Path,
+                   tests: Iterable[str] = VERIFY_TESTS,
+                   pytest_args: str = VERIFY_PYTEST_ARGS,
+                   wheelhouse: Union[Path, None] = None) -> dict:
+    """Run cpython regression tests and the project's pytest suite against the AppDir.
+
+    regrtest runs the test modules in parallel, with the free jobs of the
+    jobserver, and stops at the first failure, pytest then runs in a
+    throwaway venv of the AppDir python with the requirements of the
+    suite. Both write JUnit XML into the results
+    directory, the slowest tests are logged. Nothing is written into the
+    AppDir.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :param results_dir: Directory for the JUnit XML files and the venv
+    :type results_dir: Path
+    :param tests: regrtest modules to run
+    :type tests: Iterable[str]
+    :param pytest_args: Extra pytest arguments
+    :type pytest_args: str
+    :param wheelhouse: Wheelhouse to install the suite's requirements from, if it exists
+    :type wheelhouse: Union[Path, None]
+    :returns: Test counts and slowest tests
+    :rtype: dict
+    :raises AppImageError: A test failed
+    """
+    logging.info('Verifying AppDir.')
+    if results_dir.exists():
+        shutil.rmtree(results_dir)
+    results_dir.mkdir(parents=True)
+    tests_dir = PROJECT_DIR.joinpath('tests')
+    venv_dir = results_dir.joinpath('venv')
+    python = f'PYTHONDONTWRITEBYTECODE=1 {get_python_command(app_dir, version)}'
+    venv_python = (f'PYTHONDONTWRITEBYTECODE=1 '
+                   f'{get_python_command(app_dir, version, venv_dir.joinpath("bin", "python"))}')
+    find_links = f"--find-links '{wheelhouse}'" if wheelhouse is not None and wheelhouse.is_dir() else ''
+    try:
+        if tests:
+            with jobserver_tokens() as jobs:
+                run_command(f"{python} -m test -j{jobs} -W --failfast --slowest \
+                              --junit-xml '{results_dir}/regrtest.xml' {' '.join(tests)}", cwd=results_dir)
+        run_command(f"{python} -m venv '{venv_dir}' && \
+                      {venv_python} -m pip install --disable-pip-version-check {find_links} \
+                      --requirement '{tests_dir}/requirements.txt'")
+        run_command(f"{venv_python} -m pytest -x -p no:cacheprovider \
+                      --junitxml='{results_dir}/pytest.xml' --durations={VERIFY_SLOWEST} {pytest_args}",
+                    cwd=tests_dir)
+    finally:
+        summary = summarize_junit(results_dir.glob('*.xml'))
+        TIMELINE.current()['measurements'] = {'tests': summary}
+    return summary
+
+
+def summarize_junit(junit_files: Iterable[Path]) -> dict:
+    """Count the tests of JUnit XML files and log the slowest ones.
+
+    :param junit_files: JUnit XML files, as written by regrtest and pytest
+    :type junit_files: Iterable[Path]
+    :returns: Number of tests, failures and skips, and the slowest tests with their seconds
+    :rtype: dict
+    """
+    cases = []
+    summary = {'tests': 0, 'failures': 0, 'skipped': 0}
+    for _file in junit_files:
+        try:
+            root = ElementTree.parse(_file).getroot()
+        except (OSError, ElementTree.ParseError) as e:
+            logging.warning(f'Could not read {_file.name}: {e}')
+            continue
+        for _case in root.iter('testcase'):
+            name = '.'.join(filter(None, [_case.get('classname'), _case.get('name')]))
+            cases.append((float(_case.get('time') or 0), f'{_file.stem}: {name}'))
+            summary['tests'] += 1
+            if _case.find('failure') is not None or _case.find('error') is not None:
+                summary['failures'] += 1
+            elif _case.find('skipped') is not None:
+                summary['skipped'] += 1
+    summary['slowest'] = [{'name': _name, 'seconds': _time}
+                          for _time, _name in sorted(cases, reverse=True)[:VERIFY_SLOWEST]]
+    logging.info(f'{summary["tests"]} tests, {summary["failures"]} failed, {summary["skipped"]} skipped. Slowest:')
+    for _slow in summary['slowest']:
+        logging.info(f'{_slow["seconds"]:8.2f}s {_slow["name"]}')
+    return summary
+
+
+def get_python_release(version: str) -> str:
+    """Return the major.minor release of a python version.
+
+    :param version: Python version, e.g. 3.10.0
+    :type version: str
+    :returns: Release, e.g. 3.10
+    :rtype: str
+    """
+    return '.'.join(version.split('.')[:2])
+
+
+def get_python_lib_dir(app_dir: Path, version: str) -> Path:
+    """Return the stdlib directory of the python installed into the AppDir.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :returns: Path of usr/local/lib/pythonX.Y
+    :rtype: Path
+    """
+    return app_dir.joinpath('usr', 'local', 'lib', f'python{get_python_release(version)}')
+
+
+def get_python_executable(app_dir: Path, version: str) -> Path:
+    """Return the path of the python installed into the AppDir.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :returns: Path of usr/local/bin/pythonX.Y
+    :rtype: Path
+    """
+    return app_dir.joinpath('usr', 'local', 'bin', f'python{get_python_release(version)}')
+
+
+def get_python_environment(app_dir: Path) -> dict:
+    """Return the environment the python installed into the AppDir needs outside the AppImage.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :returns: Copy of the current environment with PYTHONHOME and LD_LIBRARY_PATH set
+    :rtype: dict
+    """
+    prefix = app_dir.joinpath('usr', 'local')
+    environment = dict(os.environ)
+    environment['PYTHONHOME'] = str(prefix)
+    environment['LD_LIBRARY_PATH'] = ':'.join(
+        filter(None, [f'{prefix}/sqlite3/lib', os.environ.get('LD_LIBRARY_PATH')])
+    )
+    return environment
+
+
+def get_python_command(app_dir: Path, version: str, executable: Union[Path, None] = None) -> str:
+    """Return a shell command running the python installed into the AppDir.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :param executable: Interpreter to run instead, e.g. that of a venv of the AppDir python
+    :type executable: Union[Path, None]
+    :returns: Interpreter invocation with the environment it needs outside the AppImage
+    :rtype: str
+    """
+    prefix = app_dir.joinpath('usr', 'local')
+    return (f'PYTHONHOME={prefix} '
+            f'LD_LIBRARY_PATH={prefix}/sqlite3/lib${{LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}} '
+            f'{executable or get_python_executable(app_dir, version)}')
+
+
+def measure_startup(app_dir: Path, version: str, runs: int = 20) -> dict:
+    """Measure how the python installed into the AppDir imports ssl and sqlite3.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :param runs: Number of launches to take the median startup time of
+    :type runs: int
+    :returns: Number of modules imported, from the zip and from disk, and the startup time in ms
+    :rtype: dict
+    """
+    executable = str(get_python_executable(app_dir, version))
+    environment = get_python_environment(app_dir)
+    try:
+        result = subprocess.run([executable, '-c', STARTUP_PROBE], env=environment,
+                                capture_output=True, text=True, check=True)
+        measurement = json.loads(result.stdout)
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([executable, '-c', 'import ssl, sqlite3'], env=environment, check=True)
+            samples.append(time.perf_counter() - started)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        raise AppImageError(f'Could not measure startup of {executable}: {e}')
+    measurement['startup_ms'] = round(statistics.median(samples) * 1000, 2)
+    return measurement
+
+
+@timed
+def zip_stdlib(app_dir: Path, version: str) -> dict:
+    """Pack the pure-python stdlib into pythonXY.zip to cut filesystem lookups.
+
+    The interpreter puts ``lib/pythonXY.zip`` on ``sys.path`` ahead of the
+    stdlib directory, so every import resolved from the zip costs a lookup
+    in an already open archive instead of stat and open calls on the FUSE
+    mount. The zip holds each module's source, for tracebacks, and its
+    precompiled bytecode, so the bytecode stage must have run. Extension
+    modules, site-packages and any package shipping data files it opens
+    from disk are kept out.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :returns: Startup measurements before and after zipping
+    :rtype: dict
+    :raises AppImageError: Packing failed or the zipped stdlib does not import
+    """
+    logging.info('Packing the pure-python stdlib into a zip.')
+    lib_dir = get_python_lib_dir(app_dir, version)
+    release = get_python_release(version).replace('.', '')
+    cache_tag = f'cpython-{release}'
+    zip_file = lib_dir.parent.joinpath(f'python{release}.zip')
+    before = measure_startup(app_dir, version)
+
+    sources = []
+    for _entry in sorted(lib_dir.iterdir()):
+        if _entry.name in ZIP_STDLIB_KEEP or _entry.name.startswith('config-'):
+            continue
+        if _entry.is_dir():
+            files = [_file for _file in _entry.rglob('*') if _file.is_file() and '__pycache__' not in _file.parts]
+            if not files or any(_file.suffix != '.py' for _file in files):
+                logging.debug(f'Keeping {_entry.name} on disk')
+                continue
+            sources.extend(sorted(files))
+        elif _entry.suffix == '.py':
+            sources.append(_entry)
+
+    tmp_zip_file = zip_file.with_name(zip_file.name + '.tmp')
+    try:
+        with zipfile.ZipFile(tmp_zip_file, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            for _source in sources:
+                bytecode = _source.parent.joinpath('__pycache__', f'{_source.stem}.{cache_tag}.pyc')
+                if not bytecode.is_file():
+                    raise AppImageError(f'{_source} has no bytecode to zip.')
+                archive_name = _source.relative_to(lib_dir)
+                archive.write(_source, str(archive_name))
+                archive.write(bytecode, str(archive_name.with_suffix('.pyc')))
+        os.replace(tmp_zip_file, zip_file)
+    except OSError as e:
+        raise AppImageError(f'Could not write {zip_file}: {e}')
+    finally:
+        tmp_zip_file.unlink(missing_ok=True)
+
+    for _source in sources:
+        _source.unlink()
+        for _bytecode in _source.parent.glob(f'__pycache__/{_source.stem}.{cache_tag}*.pyc'):
+            _bytecode.unlink()
+    for _root, _dirs, _files in os.walk(lib_dir, topdown=False):
+        if _root != str(lib_dir) and not os.listdir(_root):
+            os.rmdir(_root)
+
+    run_command(f"APPIMAGE={get_python_executable(app_dir, version)} {get_python_command(app_dir, version)} \
+                  -c 'import ssl, sqlite3, curses, appimage_venv'")
+    after = measure_startup(app_dir, version)
+    logging.info(f'Zipped {len(sources)} modules into {zip_file.name} '
+                 f'({zip_file.stat().st_size / 1024 / 1024:.1f} MiB).')
+    logging.info(f'Modules imported from disk {before["from_disk"]} -> {after["from_disk"]}, '
+                 f'from the zip {before["from_zip"]} -> {after["from_zip"]}, '
+                 f'startup {before["startup_ms"]}ms -> {after["startup_ms"]}ms.')
+    measurements = {'modules': len(sources), 'before': before, 'after': after}
+    update_build_manifest(app_dir, 'stdlib_zip', {'path': f'lib/{zip_file.name}', 'modules': len(sources)})
+    TIMELINE.current()['measurements'] = measurements
+    return measurements
+
+
+@timed
+def compile_bytecode(app_dir: Path, version: str, invalidation_mode: str = DEFAULT_INVALIDATION_MODE) -> None:
+    """Precompile the whole stdlib tree at every optimization level.
+
+    The squashfs of the AppImage is read-only, so a missing or stale pyc
+    would be recompiled in memory on every launch. The packaged interpreter
+    itself compiles the tree, with the free jobs of the jobserver, and
+    rewrites the paths recorded in the code objects from the AppDir to
+    /usr/local. The bytecode
+    ``make install`` left is only recompiled when it was written with
+    another invalidation mode, see get_install_invalidation_mode.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param version: Python version
+    :type version: str
+    :param invalidation_mode: One of INVALIDATION_MODES
+    :type invalidation_mode: str
+    :raises AppImageError: Compiling failed or left a source without bytecode
+    """
+    logging.info(f'Precompiling bytecode with {invalidation_mode} invalidation.')
+    lib_dir = get_python_lib_dir(app_dir, version)
+    force = '-f' if invalidation_mode != get_install_invalidation_mode() else ''
+    with jobserver_tokens() as jobs:
+        run_command(f"{get_python_command(app_dir, version)} -m compileall \
+                      {force} -q -j{jobs} -o0 -o1 -o2 \
+                      --invalidation-mode {invalidation_mode} \
+                      -s {app_dir} -p / \
+                      -x '{BYTECODE_EXCLUDE}' \
+                      {lib_dir}")
+    verify_bytecode(lib_dir, version, invalidation_mode)
+
+
+def get_install_invalidation_mode() -> str:
+    """Return the invalidation mode of the bytecode compiled by cpython's make install.
+
+    compileall, as run by make install, writes checked-hash pycs when
+    SOURCE_DATE_EPOCH is set and timestamp pycs otherwise.
+
+    :returns: One of INVALIDATION_MODES
+    :rtype: str
+    """
+    return 'checked-hash' if os.environ.get('SOURCE_DATE_EPOCH') else 'timestamp'
+
+
+@timed
+def verify_bytecode(lib_dir: Path, version: str, invalidation_mode: str) -> None:
+    """Check that every source has a pyc of the given mode at every optimization level.
+
+    :param lib_dir: Stdlib directory
+    :type lib_dir: Path
+    :param version: Python version
+    :type version: str
+    :param invalidation_mode: One of INVALIDATION_MODES
+    :type invalidation_mode: str
+    :raises AppImageError: A source has no or the wrong kind of bytecode
+    """
+    cache_tag = 'cpython-' + get_python_release(version).replace('.', '')
+    # Flags of the pyc header as defined by PEP 552.
+    expected_flags = {'timestamp': 0, 'checked-hash': 0b11, 'unchecked-hash': 0b01}[invalidation_mode]
+    exclude = re.compile(BYTECODE_EXCLUDE)
+    problems = []
+    sources = 0
+    for _root, _dirs, _files in os.walk(lib_dir):
+        _dirs[:] = [_dir for _dir in _dirs if _dir != '__pycache__']
+        for _file in _files:
+            source = os.path.join(_root, _file)
+            if not _file.endswith('.py') or exclude.search(source):
+                continue
+            sources += 1
+            for _suffix in ('', '.opt-1', '.opt-2'):
+                pyc = os.path.join(_root, '__pycache__', f'{_file[:-3]}.{cache_tag}{_suffix}.pyc')
+                try:
+                    with open(pyc, mode='rb') as f:
+                        flags = int.from_bytes(f.read(8)[4:8], 'little')
+                except FileNotFoundError:
+                    problems.append(f'{pyc} is missing')
+                    continue
+                if flags != expected_flags:
+                    problems.append(f'{pyc} is not {invalidation_mode}')
+
+    logging.debug(f'Verified bytecode of {sources} sources')
+    if problems:
+        raise AppImageError(f'{len(problems)} pyc files are missing or stale, e.g.\n' + '\n'.join(problems[:10]))
+
+
 # noinspection PyTypedDict
 def get_source_configs(source_dir: Path) -> dict:
     """Returns tuple of filenames for sqlite, openssl, and python sources.
 
+    Every cpython tarball is kept, sorted by version, to build one AppImage
+    each.
+
     :param source_dir: Directory that contains all source code
     :type source_dir: Path
     :returns: Source configs as a dictionary
     :rtype: dict
     """
     source_config = {
-        'cpython': {
-            'source_path': None,
-            'version': None,
-        },
+        'cpython': [],
         'openssl': {
             'source_path': None,
             'version': None,
@@ -91,18 +1242,25 @@ def get_source_configs(source_dir: Path) -> dict:
     }
 
     for _entry in source_dir.iterdir():
-        if _entry.match('sqlite*.tar.gz'):
+        if not _entry.name.endswith(ARCHIVE_SUFFIXES):
+            continue
+        if _entry.match('sqlite*'):
             source_config['sqlite']['source_path'] = _entry
             source_config['sqlite']['version'] = get_version_from_filename(_entry)
             continue
-        if _entry.match('openssl*.tar.gz'):
+        if _entry.match('openssl*'):
             source_config['openssl']['source_path'] = _entry
             source_config['openssl']['version'] = get_version_from_filename(_entry)
             continue
-        if _entry.match('cpython*.tar.gz'):
-            source_config['cpython']['source_path'] = _entry
+        if _entry.match('cpython*'):
+            source_config['cpython'].append({
+                'source_path': _entry,
+                'version': get_version_from_filename(_entry) or strip_archive_suffix(_entry.name),
+            })
             continue
 
+    source_config['cpython'].sort(key=lambda _config: [int(_part) if _part.isdigit() else 0
+                                                       for _part in re.split(r'[.a-z]+', _config['version'])])
     logging.debug(f'source_config: {source_config}')
     return source_config
 
@@ -119,26 +1277,331 @@ def get_version_from_filename(filename: Path) -> Union[str, None]:
         return None
 
     _version = filename.name.split('-', 2)[-1]
-    return _version.replace('.tar.gz', '')
+    return strip_archive_suffix(_version)
+
+
+def strip_archive_suffix(name: str) -> str:
+    """Return a file name without its source archive suffix.
+
+    :param name: File name
+    :type name: str
+    :returns: Name without any of ARCHIVE_SUFFIXES
+    :rtype: str
+    """
+    for _suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(_suffix):
+            return name[:-len(_suffix)]
+    return name
+
+
+@timed
+def extract_archive(source_file: Path, directory: Path, exclude: Iterable[str] = ()) -> None:
+    """Extract a source tarball, skipping top-level directories of its tree.
+
+    Decompression is streamed through a separate, multi-threaded where
+    available, decompressor process into tar. Without tar the archive is
+    streamed through tarfile in this process.
+
+    :param source_file: Source tarball
+    :type source_file: Path
+    :param directory: Directory to extract into
+    :type directory: Path
+    :param exclude: Names of directories directly below the top-level directory to skip, e.g. Doc
+    :type exclude: Iterable[str]
+    :raises AppImageError: Extracting failed
+    """
+    exclude = tuple(exclude)
+    started = time.perf_counter()
+    if source_file.name.endswith('.tar.xz'):
+        decompressors = ('xz -T0 -dc',)
+    else:
+        decompressors = ('pigz -dc', 'gzip -dc')
+    decompressor = next((_command for _command in decompressors if shutil.which(_command.split()[0])), None)
+    tar = shutil.which('tar')
+
+    if tar and decompressor:
+        excludes = ' '.join(f"--exclude='*/{_name}'" for _name in exclude)
+        run_command(f"{decompressor} '{source_file}' | \
+                      {tar} -x -C '{directory}' --anchored --no-wildcards-match-slash {excludes}")
+        method = decompressor.split()[0]
+    else:
+        try:
+            with tarfile.open(source_file, mode='r|*') as _tar:
+                for _member in _tar:
+                    parts = _member.name.split('/')
+                    if len(parts) > 1 and parts[1] in exclude:
+                        continue
+                    if hasattr(tarfile, 'tar_filter'):
+                        _tar.extract(_member, directory, filter='tar')
+                    else:
+                        _tar.extract(_member, directory)
+        except (OSError, tarfile.TarError) as e:
+            raise AppImageError(f'Could not extract {source_file.name}: {e}')
+        method = 'tarfile'
+    logging.info(f'Extracted {source_file.name} with {method} in {time.perf_counter() - started:.1f}s.')
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_digest(filename: Path) -> str:
+    """Return the sha256 hex digest of a source file, memoized per path.
+
+    :param filename: File to hash
+    :type filename: Path
+    :returns: Hex digest
+    :rtype: str
+    """
+    return hash_file(filename)
+
 
+def hash_file(filename: Path) -> str:
+    """Return the sha256 hex digest of a file, reading it in chunks.
 
-def run_command(command: str) -> str:
+    :param filename: File to hash
+    :type filename: Path
+    :returns: Hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with filename.open(mode='rb') as f:
+        for _chunk in iter(functools.partial(f.read, 1024 * 1024), b''):
+            digest.update(_chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_toolchain_identity() -> str:
+    """Return a string identifying the compiler toolchain of this host.
+
+    :returns: Machine, libc and compiler version
+    :rtype: str
+    """
+    compiler = os.environ.get('CC', 'cc')
+    try:
+        compiler_version = run_command(f'{compiler} --version', capture=True).splitlines()[0]
+    except (AppImageError, IndexError):
+        compiler_version = 'unknown'
+    return f'{platform.machine()} {" ".join(platform.libc_ver())} {compiler_version}'
+
+
+def get_cache_key(source_path: Path, command: str, app_dir: Path, *extra: str) -> str:
+    """Return the cache key for a stage.
+
+    The AppDir is a fresh temporary directory on every run, so its path is
+    normalized out of the command before hashing.
+
+    :param source_path: Source tarball of the stage
+    :type source_path: Path
+    :param command: Configure command of the stage
+    :type command: str
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param extra: Any other strings the artifact depends on
+    :type extra: str
+    :returns: Cache key
+    :rtype: str
+    """
+    command = ' '.join(command.replace(str(app_dir), '${APPDIR}').split())
+    parts = [get_file_digest(source_path), command, get_toolchain_identity(), *extra]
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def get_ccache_exports(base_dir: Path) -> str:
+    """Return shell exports routing compiles through ccache, when it is installed.
+
+    Paths below the base directory are rewritten relative before hashing,
+    so objects are reused across different work directories.
+
+    :param base_dir: Directory holding the build trees and the AppDir
+    :type base_dir: Path
+    :returns: Exports followed by ``&&``, or an empty string without ccache
+    :rtype: str
+    """
+    ccache = shutil.which('ccache')
+    if ccache is None:
+        logging.debug('ccache not found, compiling without a compiler cache')
+        return ''
+    compiler = os.environ.get('CC', 'cc')
+    return f"export CC='{ccache} {compiler}' CCACHE_BASEDIR={base_dir} CCACHE_NOHASHDIR=1 && "
+
+
+def build_cached(cache: Union[ArtifactCache, None],
+                 key: str,
+                 app_dir: Path,
+                 prefixes: Iterable[str],
+                 build: Callable[[], dict],
+                 exclude: Iterable[str] = ()) -> dict:
+    """Restore a stage from the cache, or build it and store the result.
+
+    :param cache: Artifact cache, or None to always build
+    :type cache: Union[ArtifactCache, None]
+    :param key: Cache key of the stage
+    :type key: str
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param prefixes: Prefixes, relative to the AppDir, installed by the stage
+    :type prefixes: Iterable[str]
+    :param build: Callable building the stage and returning its metadata
+    :type build: Callable[[], dict]
+    :param exclude: Paths below the prefixes, relative to the AppDir, neither stored nor restored
+    :type exclude: Iterable[str]
+    :returns: Stage metadata
+    :rtype: dict
+    """
+    if cache is not None:
+        with TIMELINE.span('cache restore'):
+            metadata = cache.restore(key, app_dir, exclude)
+        if metadata is not None:
+            logging.info('Restored from artifact cache.')
+            return metadata
+
+    metadata = build()
+    if cache is not None:
+        with TIMELINE.span('cache store'):
+            cache.store(key, app_dir, prefixes, metadata, exclude)
+    return metadata
+
+
+def configure_command_logs(directory: Union[Path, None], tail: int = DEFAULT_LOG_TAIL) -> None:
+    """Configure where run_command streams the output of build commands.
+
+    Log files left in the directory by a previous build are removed.
+
+    :param directory: Directory of the per-stage log files, or None to buffer output in memory
+    :type directory: Union[Path, None]
+    :param tail: Number of output lines included in the error of a failed command
+    :type tail: int
+    """
+    global _command_log_dir, _command_log_tail
+    if directory is not None:
+        directory.mkdir(parents=True, exist_ok=True)
+        for _log in directory.glob('*.log'):
+            _log.unlink()
+    _command_log_dir = directory
+    _command_log_tail = tail
+
+
+def configure_jobserver(jobs: int) -> None:
+    """Share a budget of jobs between every make of the build.
+
+    A GNU make jobserver pipe holds a token for each job beyond the first,
+    make runs started with run_make take their jobs from it, so stages
+    building in parallel stay within the budget together. Each make runs
+    one job without a token. Other parallel commands take their tokens
+    with jobserver_tokens.
+
+    :param jobs: Number of jobs
+    :type jobs: int
+    """
+    global _jobserver, _jobserver_reader, _jobserver_jobs
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'+' * (jobs - 1))
+    _jobserver = (read_fd, write_fd)
+    # A separate open file description of the read end, so it can be non-blocking without changing the one make reads.
+    _jobserver_reader = os.open(f'/proc/self/fd/{read_fd}', os.O_RDONLY | os.O_NONBLOCK)
+    _jobserver_jobs = jobs
+
+
+@contextmanager
+def jobserver_tokens() -> Iterator[int]:
+    """Take the free jobserver tokens for a parallel command other than make.
+
+    Tokens are taken without waiting, whatever makes and other commands
+    hold stays theirs, and are returned when the with statement exits.
+    Without a jobserver the whole budget is available.
+
+    :returns: Number of jobs the command may run, the tokens taken plus one
+    :rtype: Iterator[int]
+    """
+    if _jobserver is None:
+        yield _jobserver_jobs
+        return
+    tokens = b''
+    # makes read the same pipe, a token seen free may be gone before it is read, so the read must not wait.
+    while len(tokens) < _jobserver_jobs - 1:
+        try:
+            token = os.read(_jobserver_reader, _jobserver_jobs - 1 - len(tokens))
+        except BlockingIOError:
+            break
+        if not token:
+            break
+        tokens += token
+    try:
+        yield len(tokens) + 1
+    finally:
+        os.write(_jobserver[1], tokens)
+
+
+def run_make(make_command: str, source_directory: Path, tree: BuildTree) -> None:
+    """Run make in parallel, through the jobserver when one is configured.
+
+    :param make_command: make and its arguments, without -j
+    :type make_command: str
+    :param source_directory: Directory to run make in
+    :type source_directory: Path
+    :param tree: Build tree, for its exports
+    :type tree: BuildTree
+    :raises AppImageError: make failed
+    """
+    if _jobserver is None:
+        run_command(f'{tree.exports}{make_command} -j$(nproc)', cwd=source_directory)
+    else:
+        run_command(f'{tree.exports}{make_command}', cwd=source_directory, jobserver=True)
+
+
+def run_command(command: str, cwd: Union[Path, None] = None, capture: bool = False, jobserver: bool = False) -> str:
     """Run a command and return the output.
 
+    Unless the output is captured, or no log directory is configured, stdout
+    and stderr of the command are streamed line by line to the log file of
+    the running stage, named after the current thread, and echoed at debug
+    level. Only the last lines are kept in memory.
+
     :param command: Command to run
     :type command: str
-    :returns: The completed process output
+    :param cwd: Working directory of the command, defaults to the current one
+    :type cwd: Union[Path, None]
+    :param capture: Buffer the output in memory and return all of stdout
+    :type capture: bool
+    :param jobserver: Hand the jobserver to the command, see configure_jobserver
+    :type jobserver: bool
+    :returns: The completed process output, or its last lines when streamed
     :rtype: str
     :raises AppImageError: Command failed
     """
     command = ' '.join(command.split())
-    logging.debug(f'Running {command}')
-    result = subprocess.run(command, capture_output=True, shell=True)
-
-    if result.returncode != 0:
-        raise AppImageError(result.stderr.decode())
-
-    return result.stdout.decode()
+    logging.debug(f'Running {command}' + (f' in {cwd}' if cwd else ''))
+    options = {}
+    if jobserver and _jobserver is not None:
+        options['env'] = dict(os.environ, MAKEFLAGS='-j --jobserver-fds={0},{1}'.format(*_jobserver))
+        options['pass_fds'] = _jobserver
+    if capture or _command_log_dir is None:
+        with TIMELINE.span(command, kind='command'):
+            result = subprocess.run(command, capture_output=True, shell=True, cwd=cwd, **options)
+
+        if result.returncode != 0:
+            raise AppImageError(result.stderr.decode())
+
+        return result.stdout.decode()
+
+    stage = threading.current_thread().name
+    log_file = _command_log_dir.joinpath(f'{stage}.log')
+    tail = deque(maxlen=_command_log_tail)
+    with TIMELINE.span(command, kind='command'), log_file.open(mode='ab') as _log:
+        _log.write(f'$ {command}\n'.encode())
+        _log.flush()
+        with subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, **options) as process:
+            for _line in process.stdout:
+                _log.write(_line)
+                tail.append(_line)
+                logging.debug(f'[{stage}] {_line.decode(errors="replace").rstrip()}')
+        returncode = process.returncode
+
+    output = b''.join(tail).decode(errors='replace')
+    if returncode != 0:
+        raise AppImageError(f'{command} failed with exit code {returncode}, '
+                            f'last {len(tail)} lines of {log_file}:\n{output}')
+    return output
 
 
 def build_app_dir(directory: Path) -> None:
@@ -154,201 +1617,973 @@ def build_app_dir(directory: Path) -> None:
             logging.info(f'AppDir/{directory} directory already exists')
 
 
-def make_readable(directory: Path) -> None:
-    """Make libraries readable by everyone (linkable)
+@timed
+def make_readable(directory: Path) -> int:
+    """Make the whole tree readable by everyone, directories also searchable.
+
+    Only entries missing a permission are changed, symlinks are left alone.
 
     :param directory: Directory to traverse
     :type directory: Path
+    :returns: Number of entries whose mode was changed
+    :rtype: int
+    :raises AppImageError: Reading or changing a mode failed
     """
+    changed = 0
+    pending = [str(directory)]
     try:
-        run_command(f'find {directory} -type d -exec chmod o+rx {{}} \;')  # noqa: W605
-        run_command(f'find {directory} -type f -exec chmod o+r {{}} \;')  # noqa: W605
-    except AppImageError as e:
-        logging.warning(e)
+        os.chmod(directory, os.stat(directory).st_mode | 0o005)
+        while pending:
+            with os.scandir(pending.pop()) as _entries:
+                for _entry in _entries:
+                    if _entry.is_symlink():
+                        continue
+                    if _entry.is_dir():
+                        pending.append(_entry.path)
+                        required = 0o005
+                    else:
+                        required = 0o004
+                    mode = _entry.stat().st_mode
+                    if mode & required != required:
+                        os.chmod(_entry.path, mode | required)
+                        changed += 1
+    except OSError as e:
+        raise AppImageError(f'Could not make {directory} readable: {e}')
+    logging.debug(f'Changed the mode of {changed} entries below {directory}')
+    return changed
+
+
+@contextmanager
+def source_tree(source_file: Path, tree: BuildTree, exclude: Iterable[str] = ()) -> Iterator[Path]:
+    """Unpack a source tarball and yield the top-level directory of its tree.
+
+    The tarball may already be unpacking in the background, see
+    BuildTree.extract. In a persistent build tree, a tarball is unpacked
+    only once, into a directory named after its digest, and left in place
+    afterwards. Otherwise the tree is removed when the with statement exits.
+
+    :param source_file: Source tarball
+    :type source_file: Path
+    :param tree: Where to unpack and build
+    :type tree: BuildTree
+    :param exclude: Top-level directories of the tree to skip
+    :type exclude: Iterable[str]
+    :returns: Top-level directory of the unpacked source
+    :rtype: Iterator[Path]
+    :raises AppImageError: The tarball does not contain a single top-level directory
+    """
+    with TIMELINE.span(f'wait for {source_file.name}'):
+        directory = tree.extract(source_file, exclude).result()
+
+    try:
+        unpacked = [_entry for _entry in directory.iterdir() if _entry.is_dir()]
+        if len(unpacked) != 1:
+            raise AppImageError(f'Expected a single top-level directory in {source_file.name}.')
+        yield unpacked[0]
+    finally:
+        if not tree.persistent:
+            shutil.rmtree(directory)
 
 
-def configure_sqlite(sqlite_config: dict, app_dir: Path) -> None:
+def run_configure(command: str, source_directory: Path, tree: BuildTree) -> None:
+    """Run configure, unless a persistent tree was already configured with the same command.
+
+    :param command: Configure command
+    :type command: str
+    :param source_directory: Unpacked source tree
+    :type source_directory: Path
+    :param tree: Where to unpack and build
+    :type tree: BuildTree
+    :raises AppImageError: Configure failed
+    """
+    stamp = source_directory.joinpath('.appimage-configure')
+    digest = hashlib.sha256(f'{tree.exports}{command}'.encode()).hexdigest()
+    if tree.persistent and stamp.exists() and stamp.read_text() == digest:
+        logging.info('Configure flags unchanged, reusing the configured tree.')
+        return
+    stamp.unlink(missing_ok=True)
+    run_command(f'{tree.exports}{command}', cwd=source_directory)
+    stamp.write_text(digest)
+
+
+def configure_sqlite(sqlite_config: dict,
+                     app_dir: Path,
+                     cache: Union[ArtifactCache, None] = None,
+                     tree: Union[BuildTree, None] = None,
+                     profile: str = DEFAULT_SQLITE_PROFILE) -> str:
     """Configure and compile sqlite source.
 
+    The compile time options of the profile are passed as ``-DSQLITE_*``
+    CFLAGS and recorded in the manifest.
+
     :param sqlite_config: Dictionary of sqlite config
     :type sqlite_config: dict
     :param app_dir: Path object pointing to AppDir
     :type app_dir: Path
+    :param cache: Artifact cache, or None to always build
+    :type cache: Union[ArtifactCache, None]
+    :param tree: Where to unpack and build, defaults to a throwaway tree in the AppDir
+    :type tree: Union[BuildTree, None]
+    :param profile: Name of the compile profile, one of SQLITE_PROFILES
+    :type profile: str
+    :returns: Cache key of the installed sqlite
+    :rtype: str
     :raises AppImageError: Compiling sqlite failed
     """
-    logging.info('Compiling and installing sqlite.')
-    target_directory = app_dir.joinpath('src')
+    logging.info(f'Compiling and installing sqlite with the {profile} profile.')
+    try:
+        sqlite_profile = SQLITE_PROFILES[profile]
+    except KeyError:
+        raise AppImageError(f'Unknown sqlite profile {profile}.')
+    tree = tree or BuildTree(app_dir.joinpath('src'))
     version = sqlite_config.get('version')
-    unpacked_directory = target_directory.joinpath(f'sqlite-autoconf-{version}')
     source_file = sqlite_config.get('source_path')
-    shutil.unpack_archive(str(source_file), str(target_directory))
-    os.chdir(unpacked_directory)
-
-    try:
-        run_command('./configure --prefix=/usr/local/sqlite3')
-        run_command('make -j$(nproc)')
-        run_command(f'make install DESTDIR={app_dir}')
-        make_readable(app_dir.joinpath('usr', 'local', 'sqlite3'))
-    except AppImageError:
-        raise
-    finally:
-        os.chdir(PROJECT_DIR)
-        shutil.rmtree(str(unpacked_directory))
-
-
-def configure_openssl(openssl_config: dict, app_dir: Path) -> None:
+    cflags = ' '.join([*sqlite_profile['cflags'], *(f'-DSQLITE_{_option}' for _option in sqlite_profile['options'])])
+    configure_command = './configure --prefix=/usr/local/sqlite3'
+    if cflags:
+        configure_command += f' CFLAGS="{cflags}"'
+    key = get_cache_key(source_file, configure_command, app_dir)
+
+    def _build() -> dict:
+        with source_tree(source_file, tree) as unpacked_directory:
+            run_configure(configure_command, unpacked_directory, tree)
+            run_make('make', unpacked_directory, tree)
+            run_command(f'make install DESTDIR={app_dir}', cwd=unpacked_directory)
+            return {'version': version}
+
+    build_cached(cache, key, app_dir, ['usr/local/sqlite3'], _build)
+    update_build_manifest(app_dir, 'sqlite', {
+        'version': version,
+        'profile': profile,
+        'compile_options': list(sqlite_profile['options']),
+        'cflags': list(sqlite_profile['cflags']),
+    })
+    return key
+
+
+def configure_openssl(openssl_config: dict,
+                      app_dir: Path,
+                      cache: Union[ArtifactCache, None] = None,
+                      tree: Union[BuildTree, None] = None,
+                      options: Iterable[str] = OPENSSL_OPTIONS,
+                      speed: bool = False) -> str:
     """Configure and compile openssl source.
 
+    Only the libraries, programs and the openssl directory are installed,
+    no documentation. Unless ``no-asm`` is among the options, the build
+    fails when the assembly implementations are not enabled.
+
     :param openssl_config: Dictionary of sqlite config
     :type openssl_config: dict
     :param app_dir: Path object pointing to AppDir
     :type app_dir: Path
+    :param cache: Artifact cache, or None to always build
+    :type cache: Union[ArtifactCache, None]
+    :param tree: Where to unpack and build, defaults to a throwaway tree in the AppDir
+    :type tree: Union[BuildTree, None]
+    :param options: Options passed to openssl's config, see OPENSSL_OPTIONS
+    :type options: Iterable[str]
+    :param speed: Compare openssl speed of the build with the previous build, see compare_openssl_speed
+    :type speed: bool
+    :returns: Cache key of the installed openssl
+    :rtype: str
     :raises AppImageError: Compiling ssl failed
     """
     logging.info('Compiling and installing openssl.')
-    target_directory = app_dir.joinpath('src')
+    tree = tree or BuildTree(app_dir.joinpath('src'))
+    options = tuple(options)
     version = openssl_config.get('version')
-    unpacked_directory = target_directory.joinpath(f'openssl-{version}')
     source_file = openssl_config.get('source_path')
-    shutil.unpack_archive(str(source_file), str(target_directory))
-    os.chdir(unpacked_directory)
+    config_options = ' '.join(options)
+    configure_command = f'./config \
+                         {config_options} \
+                         --prefix=/usr/local/ssl \
+                         --openssldir=/usr/local/ssl'
+    key = get_cache_key(source_file, configure_command, app_dir)
+
+    def _build() -> dict:
+        with source_tree(source_file, tree) as unpacked_directory:
+            run_configure(configure_command, unpacked_directory, tree)
+            asm = 'OPENSSL_CPUID_OBJ' in unpacked_directory.joinpath('Makefile').read_text()
+            if not asm and 'no-asm' not in options:
+                raise AppImageError('openssl was configured without assembly, check that perl and the '
+                                    'assembler support this platform.')
+            run_make('make', unpacked_directory, tree)
+            run_command(f'make install_sw install_ssldirs DESTDIR={app_dir}', cwd=unpacked_directory)
+            return {'version': version, 'asm': asm}
+
+    metadata = build_cached(cache, key, app_dir, ['usr/local/ssl'], _build)
+    update_build_manifest(app_dir, 'openssl', {
+        'version': version,
+        'options': list(options),
+        'asm': metadata.get('asm'),
+    })
+    if speed:
+        compare_openssl_speed(str(app_dir.joinpath('usr', 'local', 'ssl', 'bin', 'openssl')), cache,
+                              {'key': key, 'version': version, 'options': list(options)})
+    return key
+
+
+def compare_openssl_speed(openssl: str, cache: Union[ArtifactCache, None], build: dict) -> dict:
+    """Measure openssl speed and compare it with the openssl of the previous build.
+
+    The figures are recorded in the artifact cache, together with the
+    details of the build, for the next build to compare with. Without a
+    cache nothing is compared.
+
+    :param openssl: Built openssl program
+    :type openssl: str
+    :param cache: Artifact cache holding the figures of the previous build, or None
+    :type cache: Union[ArtifactCache, None]
+    :param build: Cache key, version and options of the built openssl
+    :type build: dict
+    :returns: Figures of this build and the record of the previous build, None when there is none
+    :rtype: dict
+    """
+    built = measure_openssl_speed(openssl)
+    previous = cache.load_measurements('openssl-speed') if cache is not None else None
+    if previous is None:
+        logging.info('No openssl speed of a previous build to compare with.')
+        log_openssl_speed({'built': built})
+    else:
+        logging.info(f'Comparing openssl speed with the previous build of openssl {previous["version"]} '
+                     f'({" ".join(previous["options"])}).')
+        log_openssl_speed({'previous': previous['speed'], 'built': built})
+    if cache is not None:
+        cache.store_measurements('openssl-speed', dict(build, speed=built))
+    measurements = {'built': built, 'previous': previous}
+    TIMELINE.current()['measurements'] = {'openssl_speed': measurements}
+    return measurements
+
+
+def measure_openssl_speed(openssl: str, seconds: int = 1) -> dict:
+    """Run openssl speed for each of OPENSSL_SPEED_TESTS.
+
+    :param openssl: openssl program to measure
+    :type openssl: str
+    :param seconds: Duration of each measurement
+    :type seconds: int
+    :returns: MiB/s of ciphers and digests, operations/s of key exchanges, None where openssl failed
+    :rtype: dict
+    """
+    results = {}
+    for _name, _arguments in OPENSSL_SPEED_TESTS.items():
+        results[_name] = None
+        try:
+            output = run_command(f'{openssl} speed -mr -seconds {seconds} {_arguments}', capture=True)
+        except AppImageError as e:
+            logging.warning(f'openssl speed {_name} failed with {openssl}: {e}')
+            continue
+        for _line in output.splitlines():
+            fields = _line.split(':')
+            if fields[0] == '+F':
+                results[_name] = float(fields[-1]) / (1024 * 1024)
+            elif fields[0] in ('+F4', '+F5'):
+                results[_name] = float(fields[3])
+    return results
 
-    try:
-        run_command('./config \
-                     no-shared \
-                     -fPIC \
-                     --prefix=/usr/local/ssl \
-                     --openssldir=/usr/local/ssl')
-        run_command('make -j$(nproc)')
-        run_command(f'make install DESTDIR={app_dir}')
-        make_readable(app_dir.joinpath('usr', 'local', 'ssl'))
-    except AppImageError:
-        raise
-    finally:
-        os.chdir(PROJECT_DIR)
-        shutil.rmtree(str(unpacked_directory))
 
+def log_openssl_speed(measurements: dict) -> None:
+    """Log openssl speed results side by side.
 
-def configure_python(python_config: dict, app_dir: Path) -> str:
+    :param measurements: Results of measure_openssl_speed keyed by build
+    :type measurements: dict
+    """
+    builds = list(measurements)
+    logging.info(f'{"openssl speed":<20}' + ''.join(f'{_build:>12}' for _build in builds))
+    for _name in OPENSSL_SPEED_TESTS:
+        unit = 'op/s' if _name.startswith('ecdh') else 'MiB/s'
+        values = [measurements[_build].get(_name) for _build in builds]
+        cells = ['-' if _value is None else f'{_value:.0f}' for _value in values]
+        logging.info(f'{_name:<20}' + ''.join(f'{_cell:>12}' for _cell in cells) + f' {unit}')
+
+
+def configure_python(python_config: dict,
+                     app_dir: Path,
+                     cache: Union[ArtifactCache, None] = None,
+                     dependencies: Iterable[str] = (),
+                     profile: str = DEFAULT_BUILD_PROFILE,
+                     pgo_task: Union[str, None] = None,
+                     tree: Union[BuildTree, None] = None,
+                     deps_dir: Union[Path, None] = None) -> str:
     """Configure and compile python source.
 
+    With the ``optimized`` profile ``make`` builds an instrumented
+    interpreter, runs the PGO training task with it and rebuilds using the
+    collected profile, all before ``make install``.
+
+    sqlite and openssl are linked from the dependency directory, which may
+    be shared by several interpreters, and copied into the AppDir.
+
     :param python_config: Dictionary of python config
     :type python_config: dict
     :param app_dir: Path object pointing to AppDir
     :type app_dir: Path
+    :param cache: Artifact cache, or None to always build
+    :type cache: Union[ArtifactCache, None]
+    :param dependencies: Cache keys of the sqlite and openssl builds linked in
+    :type dependencies: Iterable[str]
+    :param profile: Name of the build profile, one of BUILD_PROFILES
+    :type profile: str
+    :param pgo_task: Arguments of the PGO training run, defaults to cpython's own
+    :type pgo_task: Union[str, None]
+    :param tree: Where to unpack and build, defaults to a throwaway tree in the AppDir
+    :type tree: Union[BuildTree, None]
+    :param deps_dir: Directory sqlite and openssl were installed into, defaults to the AppDir
+    :type deps_dir: Union[Path, None]
     :returns: Python version compiled
     :rtype: str
     :raises AppImageError: Compiling python failed
     """
-    logging.info('Compiling and installing python.')
-    target_directory = app_dir.joinpath('src')
-    source_file = python_config.get('source_path')
-    shutil.unpack_archive(str(source_file), str(target_directory))
-    version = None
-
-    for _entry in target_directory.glob('cpython*'):
-        if _entry.is_dir():
-            version = get_version_from_filename(_entry)
-            break
-    if version is None:
-        raise AppImageError('Could not determine unpacked cpython directory.')
-
-    unpacked_directory = target_directory.joinpath(f'cpython-{version}')
-    ld_flags = f'-Wl,-rpath={app_dir}/usr/local/sqlite3/lib,-rpath={app_dir}/usr/local/ssl/lib'
-    cpp_flags = f'-I{app_dir}/usr/local/sqlite3/include -I{app_dir}/usr/local/ssl/include'
-
-    os.chdir(unpacked_directory)
-
+    logging.info(f'Compiling and installing python with the {profile} profile.')
     try:
-        py_install = run_command(f'export LDFLAGS="{ld_flags}" && \
-                                   export CPPFLAGS="{cpp_flags}" && \
-                                   ./configure \
-                                   --with-pydebug \
-                                   --enable-loadable-sqlite-extensions \
-                                   --with-openssl={app_dir}/usr/local/ssl \
-                                   --prefix=/usr/local')
-        logging.debug(py_install)
-        run_command('make -j$(nproc)')
-        run_command(f'make install DESTDIR={app_dir}')
-        return version
-    except AppImageError:
-        raise
-    finally:
-        os.chdir(PROJECT_DIR)
-        shutil.rmtree(str(unpacked_directory))
-
+        profile_flags = BUILD_PROFILES[profile]
+    except KeyError:
+        raise AppImageError(f'Unknown build profile {profile}.')
+    tree = tree or BuildTree(app_dir.joinpath('src'))
+    deps_dir = deps_dir or app_dir
+    source_file = python_config.get('source_path')
+    ld_flags = f'-Wl,-rpath={deps_dir}/usr/local/sqlite3/lib,-rpath={deps_dir}/usr/local/ssl/lib'
+    cpp_flags = f'-I{deps_dir}/usr/local/sqlite3/include -I{deps_dir}/usr/local/ssl/include'
+    profile_options = ' '.join(profile_flags)
+    configure_command = f'export LDFLAGS="{ld_flags}" && \
+                          export CPPFLAGS="{cpp_flags}" && \
+                          ./configure \
+                          {profile_options} \
+                          --enable-loadable-sqlite-extensions \
+                          --with-openssl={deps_dir}/usr/local/ssl \
+                          --prefix=/usr/local'
+    make_command = 'make'
+    if pgo_task and '--enable-optimizations' in profile_flags:
+        make_command += f" PROFILE_TASK='{pgo_task}'"
+    key = get_cache_key(source_file, configure_command.replace(str(deps_dir), '${DEPSDIR}'), app_dir,
+                        make_command, *dependencies)
+    if deps_dir != app_dir:
+        for _prefix in ('usr/local/sqlite3', 'usr/local/ssl'):
+            shutil.copytree(deps_dir.joinpath(_prefix), app_dir.joinpath(_prefix), symlinks=True)
+        try:
+            with deps_dir.joinpath(MANIFEST_PATH).open() as f:
+                for _section, _values in json.load(f).items():
+                    update_build_manifest(app_dir, _section, _values)
+        except FileNotFoundError:
+            pass
+
+    def _build() -> dict:
+        with source_tree(source_file, tree, SOURCE_EXCLUDES['cpython']) as unpacked_directory:
+            version = get_version_from_filename(unpacked_directory)
+            if version is None:
+                raise AppImageError('Could not determine unpacked cpython directory.')
+            run_configure(configure_command, unpacked_directory, tree)
+            run_make(make_command, unpacked_directory, tree)
+            run_command(f'make install DESTDIR={app_dir}', cwd=unpacked_directory)
+            return {'version': version}
+
+    prefixes = ['usr/local/bin', 'usr/local/include', 'usr/local/lib', 'usr/local/share']
+    # The manifest of the build in progress must not be replaced by that of the cached build.
+    version = build_cached(cache, key, app_dir, prefixes, _build, exclude=[MANIFEST_PATH.parent.as_posix()])['version']
+    update_build_manifest(app_dir, 'python', {
+        'version': version,
+        'profile': profile,
+        'configure_flags': list(profile_flags),
+        'pgo_task': pgo_task if '--enable-optimizations' in profile_flags else None,
+    })
+    return version
+
+
+def update_build_manifest(app_dir: Path, section: str, values: dict) -> None:
+    """Record build details in the manifest shipped inside the image.
+
+    The manifest is a JSON document at ``share/python-appimage/manifest.json``
+    below ``sys.prefix`` of the packaged interpreter, with one section per
+    component.
 
-def build_app_image(app_dir: Path, resources_dir: Path) -> None:
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param section: Name of the section to replace
+    :type section: str
+    :param values: Content of the section
+    :type values: dict
+    """
+    manifest_file = app_dir.joinpath(MANIFEST_PATH)
+    with _manifest_lock:
+        try:
+            with manifest_file.open() as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        manifest[section] = values
+        manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        with manifest_file.open(mode='w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+@timed
+def build_app_image(app_dir: Path,
+                    resources_dir: Path,
+                    version: str,
+                    compression: str = DEFAULT_COMPRESSION_PROFILE,
+                    compare_compression: bool = False,
+                    deps_dir: Union[Path, None] = None) -> None:
     """Build the AppImage.
 
+    linuxdeploy completes the AppDir, appimagetool then packs it with the
+    squashfs settings of the compression profile.
+
     :param app_dir: Base AppDir directory
     :type app_dir: Path
     :param resources_dir: Directory that contains the resources
     :type resources_dir: Path
+    :param version: Python version
+    :type version: str
+    :param compression: Name of the compression profile, one of COMPRESSION_PROFILES
+    :type compression: str
+    :param compare_compression: Also build and measure the image with every other profile
+    :type compare_compression: bool
+    :param deps_dir: Directory sqlite and openssl were built into before being copied into the AppDir
+    :type deps_dir: Union[Path, None]
     :raises AppImageError: Creating AppImage failed
     """
     logging.info('Building AppImage.')
     icon_file = resources_dir.joinpath('icons', 'python.png')
     desktop_file = resources_dir.joinpath('io.nucoder.python.desktop')
-    app_run_file = resources_dir.joinpath('AppRun')
-    shutil.copy(app_run_file, app_dir)
-    app_dir.joinpath('AppRun').chmod(0o755)
+    write_app_run(app_dir, resources_dir, version)
 
-    libraries = get_system_libraries()
+    libraries = get_system_libraries(app_dir, deps_dir)
 
     try:
-        run_command(f'ARCH=x86_64 OUTPUT=python3.10.0.AppImage \
+        run_command(f'ARCH=x86_64 \
                       {resources_dir}/linuxdeploy-x86_64.AppImage \
                       {libraries} \
                       --appdir={app_dir} \
                       --icon-file={icon_file} \
-                      --desktop-file={desktop_file} \
-                      --output=appimage')
+                      --desktop-file={desktop_file}')
     except AppImageError:
         raise
 
+    make_readable(app_dir)
 
-def get_system_libraries() -> str:
-    """Return string of library flags to pass to linuxdeploy.
+    output = Path(f'python{version}.AppImage').absolute()
+    if not compare_compression:
+        package_app_image(app_dir, resources_dir, output, compression)
+        return
 
+    measurements = {}
+    for _profile in COMPRESSION_PROFILES:
+        variant = output.with_name(f'{output.stem}-{_profile}{output.suffix}')
+        package_app_image(app_dir, resources_dir, variant, _profile)
+        measurements[_profile] = measure_app_image(variant)
+    log_compression_comparison(measurements)
+    TIMELINE.current()['measurements'] = {'compression': measurements}
+    # Every variant is kept, the selected one is also copied onto the output name.
+    shutil.copy2(output.with_name(f'{output.stem}-{compression}{output.suffix}'), output)
+
+
+def package_app_image(app_dir: Path, resources_dir: Path, output: Path, compression: str) -> None:
+    """Pack the AppDir into an AppImage with the settings of a compression profile.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param resources_dir: Directory that contains the resources
+    :type resources_dir: Path
+    :param output: AppImage to write
+    :type output: Path
+    :param compression: Name of the compression profile, one of COMPRESSION_PROFILES
+    :type compression: str
+    :raises AppImageError: Packing failed
+    """
+    try:
+        profile = COMPRESSION_PROFILES[compression]
+    except KeyError:
+        raise AppImageError(f'Unknown compression profile {compression}.')
+    logging.info(f'Packing {output.name} with the {compression} compression profile.')
+    squashfs_options = ('-b', str(profile['block_size'])) + profile['options']
+    squashfs_flags = ' '.join(f"--mksquashfs-opt '{_option}'" for _option in squashfs_options)
+    with TIMELINE.span(f'package {compression}'):
+        run_command(f"ARCH=x86_64 \
+                      {resources_dir}/appimagetool-x86_64.AppImage \
+                      --comp {profile['compression']} \
+                      {squashfs_flags} \
+                      {app_dir} {output}")
+
+
+def measure_app_image(image: Path, runs: int = 5) -> dict:
+    """Measure the size, launch times and full read time of an AppImage.
+
+    A cold launch follows dropping the page cache, which needs root; without
+    it the first launch is reported as cold.
+
+    :param image: AppImage to measure
+    :type image: Path
+    :param runs: Number of warm launches to take the median of
+    :type runs: int
+    :returns: Size in bytes, cold and warm launch time in ms and full read time in s
+    :rtype: dict
+    """
+    def _launch(*arguments: str) -> float:
+        started = time.perf_counter()
+        try:
+            subprocess.run([str(image), *arguments], check=True, stdout=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise AppImageError(f'Could not run {image.name}: {e}')
+        return time.perf_counter() - started
+
+    def _drop_caches() -> bool:
+        os.sync()
+        try:
+            Path('/proc/sys/vm/drop_caches').write_text('3\n')
+        except OSError:
+            return False
+        return True
+
+    caches_dropped = _drop_caches()
+    cold = _launch('-c', 'pass')
+    warm = statistics.median(_launch('-c', 'pass') for _ in range(runs))
+    _drop_caches()
+    full_read = _launch('-c', FULL_READ_PROBE)
+    return {
+        'size': image.stat().st_size,
+        'cold_ms': round(cold * 1000, 1),
+        'warm_ms': round(warm * 1000, 1),
+        'full_read_s': round(full_read, 2),
+        'caches_dropped': caches_dropped,
+    }
+
+
+def log_compression_comparison(measurements: dict) -> None:
+    """Log a table comparing the AppImage built with each compression profile.
+
+    :param measurements: Measurements of measure_app_image keyed by profile name
+    :type measurements: dict
+    """
+    logging.info(f'{"profile":<12} {"size":>10} {"cold":>9} {"warm":>9} {"full read":>10}')
+    for _profile, _measured in measurements.items():
+        logging.info(f'{_profile:<12} {_measured["size"] / 1024 / 1024:7.1f}MiB '
+                     f'{_measured["cold_ms"]:7.1f}ms {_measured["warm_ms"]:7.1f}ms '
+                     f'{_measured["full_read_s"]:9.2f}s')
+    if not all(_measured['caches_dropped'] for _measured in measurements.values()):
+        logging.warning('Could not drop the page cache, cold launches are first launches only.')
+
+
+@timed
+def prune_app_dir(app_dir: Path, manifest_file: Path) -> dict:
+    """Remove, strip and deduplicate files of the AppDir as declared in a manifest.
+
+    The manifest is a JSON document with ``categories`` of glob patterns,
+    relative to the AppDir, to remove when the category is ``enabled``.
+    Paths matching a ``keep`` pattern are never removed, also when they are
+    inside a removed directory. With ``strip`` every ELF file is stripped of
+    unneeded symbols and with ``deduplicate`` identical files are replaced
+    by hard links. The removed categories are recorded in the build manifest.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param manifest_file: Prune manifest
+    :type manifest_file: Path
+    :returns: Bytes saved per category
+    :rtype: dict
+    :raises AppImageError: The manifest is invalid or stripping failed
+    """
+    logging.info(f'Pruning AppDir as declared in {manifest_file.name}.')
+    try:
+        with manifest_file.open() as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise AppImageError(f'Could not read prune manifest {manifest_file}: {e}')
+    keep = manifest.get('keep', [])
+
+    saved = {}
+    for _category, _config in manifest.get('categories', {}).items():
+        if not _config.get('enabled', True):
+            continue
+        saved[_category] = 0
+        for _pattern in _config.get('remove', []):
+            for _path in sorted(app_dir.glob(_pattern)):
+                saved[_category] += remove_unkept(app_dir, _path, keep)
+    # Tests of the image that need a pruned category skip themselves.
+    update_build_manifest(app_dir, 'prune', {'categories': list(saved)})
+    if manifest.get('strip', False):
+        saved['strip'] = strip_elf_files(app_dir)
+    if manifest.get('deduplicate', False):
+        saved['deduplicate'] = deduplicate_files(app_dir)
+
+    for _category, _bytes in saved.items():
+        logging.info(f'Pruned {_category:<20} {_bytes / 1024 / 1024:8.1f} MiB')
+    logging.info(f'Pruned {"total":<20} {sum(saved.values()) / 1024 / 1024:8.1f} MiB')
+    TIMELINE.current()['measurements'] = {'bytes_saved': saved}
+    return saved
+
+
+def get_tree_size(path: Path) -> int:
+    """Return the apparent size of a file or directory tree, not following symlinks.
+
+    :param path: File or directory
+    :type path: Path
+    :returns: Size in bytes
+    :rtype: int
+    """
+    if path.is_symlink() or not path.is_dir():
+        return path.lstat().st_size
+    size = 0
+    for _root, _dirs, _files in os.walk(path):
+        for _name in _files:
+            size += os.lstat(os.path.join(_root, _name)).st_size
+    return size
+
+
+def remove_unkept(app_dir: Path, path: Path, keep: Iterable[str]) -> int:
+    """Remove a path unless a keep pattern matches it or anything below it.
+
+    :param app_dir: Base AppDir directory the patterns are relative to
+    :type app_dir: Path
+    :param path: File or directory to remove
+    :type path: Path
+    :param keep: Glob patterns of paths to keep
+    :type keep: Iterable[str]
+    :returns: Bytes removed
+    :rtype: int
+    """
+    relative = path.relative_to(app_dir).as_posix()
+    if any(fnmatch.fnmatchcase(relative, _pattern) for _pattern in keep):
+        return 0
+    if path.is_dir() and not path.is_symlink():
+        depth = len(relative.split('/'))
+        for _pattern in keep:
+            parts = _pattern.split('/')
+            if len(parts) > depth and fnmatch.fnmatchcase(relative, '/'.join(parts[:depth])):
+                return sum(remove_unkept(app_dir, _child, keep) for _child in path.iterdir())
+
+    size = get_tree_size(path)
+    logging.debug(f'Removing {relative}')
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+    return size
+
+
+def iter_regular_files(directory: Path) -> Iterator[Path]:
+    """Yield every regular file below a directory, not following symlinks."""
+    for _root, _dirs, _files in os.walk(directory):
+        for _name in _files:
+            path = Path(_root, _name)
+            if not path.is_symlink():
+                yield path
+
+
+def strip_elf_files(app_dir: Path, batch: int = 200) -> int:
+    """Strip unneeded symbols and debug information from every ELF file.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param batch: Number of files passed to one strip invocation
+    :type batch: int
+    :returns: Bytes saved
+    :rtype: int
+    :raises AppImageError: Stripping failed
+    """
+    elf_files = []
+    for _path in iter_regular_files(app_dir):
+        with _path.open(mode='rb') as f:
+            if f.read(4) == b'\x7fELF':
+                elf_files.append(_path)
+    before = sum(_path.stat().st_size for _path in elf_files)
+    for _index in range(0, len(elf_files), batch):
+        paths = ' '.join(f"'{_path}'" for _path in elf_files[_index:_index + batch])
+        run_command(f'strip --strip-unneeded {paths}')
+    return before - sum(_path.stat().st_size for _path in elf_files)
+
+
+def deduplicate_files(app_dir: Path) -> int:
+    """Replace files with identical content and mode by hard links to one copy.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :returns: Bytes saved
+    :rtype: int
+    """
+    by_size = {}
+    for _path in iter_regular_files(app_dir):
+        stat = _path.stat()
+        if stat.st_size:
+            by_size.setdefault((stat.st_size, stat.st_mode), []).append(_path)
+
+    saved = 0
+    for (_size, _mode), _paths in by_size.items():
+        if len(_paths) < 2:
+            continue
+        originals = {}
+        for _path in _paths:
+            stat = _path.stat()
+            digest = hash_file(_path)
+            original = originals.setdefault(digest, _path)
+            if original == _path or original.stat().st_ino == stat.st_ino:
+                continue
+            link = _path.with_name(f'.{_path.name}.dedupe')
+            os.link(original, link)
+            os.replace(link, _path)
+            saved += _size
+    return saved
+
+
+def write_app_run(app_dir: Path, resources_dir: Path, version: str) -> None:
+    """Render the AppRun template with the resolved interpreter into the AppDir.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param resources_dir: Directory that contains the resources
+    :type resources_dir: Path
+    :param version: Python version
+    :type version: str
+    :raises AppImageError: The interpreter is missing from the AppDir
+    """
+    executable = get_python_executable(app_dir, version)
+    if not executable.is_file():
+        raise AppImageError(f'{executable} not found, cannot write AppRun.')
+    template = resources_dir.joinpath('AppRun').read_text()
+    app_run_file = app_dir.joinpath('AppRun')
+    app_run_file.write_text(template.replace('__PYTHON_EXECUTABLE__', executable.name))
+    app_run_file.chmod(0o755)
+
+
+def get_system_libraries(app_dir: Path, deps_dir: Union[Path, None] = None) -> str:
+    """Return the library flags to pass to linuxdeploy.
+
+    Exactly the host libraries the ELF files of the AppDir need are
+    bundled, see get_library_closure. Which files pulled each one in is
+    logged and recorded in the manifest.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param deps_dir: Directory sqlite and openssl were built into, their copies in the AppDir are used instead
+    :type deps_dir: Union[Path, None]
     :returns: String of flags
     :rtype: str
+    :raises AppImageError: A needed library was not found
     """
-    linux_distro = get_linux_distro()
-    if linux_distro == 'Debian':
-        # debian 10
-        return '--library=/lib/x86_64-linux-gnu/libreadline.so.7 \
-                --library=/lib/x86_64-linux-gnu/libhistory.so.7 \
-                --library=/lib/x86_64-linux-gnu/libncurses.so.6 \
-                --library=/lib/x86_64-linux-gnu/libncursesw.so.6'
-    elif linux_distro == 'Ubuntu':
-        # ubuntu 20.04
-        return '--library=/lib/x86_64-linux-gnu/libreadline.so.8 \
-                --library=/lib/x86_64-linux-gnu/libhistory.so.8 \
-                --library=/lib/x86_64-linux-gnu/libncurses.so.6 \
-                --library=/lib/x86_64-linux-gnu/libncursesw.so.6'
+    aliases = [(str(deps_dir), str(app_dir))] if deps_dir is not None and deps_dir != app_dir else []
+    libraries = get_library_closure(app_dir, aliases)
+    for _library, _users in sorted(libraries.items()):
+        users = ', '.join(str(_user.relative_to(app_dir)) for _user in _users)
+        logging.info(f'Bundling {_library} for {users}')
+    update_build_manifest(app_dir, 'libraries', {
+        str(_library): sorted(str(_user.relative_to(app_dir)) for _user in _users)
+        for _library, _users in libraries.items()
+    })
+    return ' '.join(f"--library='{_library}'" for _library in sorted(libraries))
+
+
+def get_library_closure(app_dir: Path, aliases: Iterable[Tuple[str, str]] = ()) -> Dict[Path, list]:
+    """Resolve the host libraries needed by the executables and libraries of the AppDir.
+
+    Dependencies are followed transitively, through the AppDir's own
+    libraries too, but libraries in SYSTEM_LIBRARY_EXCLUDES are neither
+    bundled nor followed.
+
+    :param app_dir: Base AppDir directory
+    :type app_dir: Path
+    :param aliases: Directories linked into RPATH and RUNPATH at build time, with their copy in the AppDir
+    :type aliases: Iterable[Tuple[str, str]]
+    :returns: Each host library to bundle, with the AppDir files that need it directly or through others
+    :rtype: Dict[Path, list]
+    :raises AppImageError: A needed library was not found
+    """
+    app_dir_paths = [str(app_dir.joinpath(_dir)) for _dir in APP_DIR_LIBRARY_DIRS]
+    search_path = app_dir_paths + get_host_library_dirs()
+    roots = [_path for _path in iter_regular_files(app_dir) if read_elf_dynamic(_path) is not None]
+    aliases = tuple(aliases)
+
+    libraries = {}
+    missing = {}
+    for _root in roots:
+        pending = [_root]
+        seen = {_root}
+        while pending:
+            path = pending.pop()
+            elf = read_elf_dynamic(path)
+            for _name in elf.needed:
+                if any(fnmatch.fnmatch(_name, _pattern) for _pattern in SYSTEM_LIBRARY_EXCLUDES):
+                    continue
+                library = resolve_library(_name, path, elf, search_path, aliases)
+                if library is None:
+                    missing.setdefault(_name, _root)
+                    continue
+                if library in seen:
+                    continue
+                seen.add(library)
+                pending.append(library)
+                if app_dir not in library.parents:
+                    libraries.setdefault(library, []).append(_root)
+    if missing:
+        raise AppImageError('Libraries not found: ' + ', '.join(f'{_name} (needed by {_root.relative_to(app_dir)})'
+                                                                for _name, _root in missing.items()))
+    return libraries
+
+
+def resolve_library(name: str,
+                    loader: Path,
+                    elf: ElfDynamic,
+                    search_path: list,
+                    aliases: Iterable[Tuple[str, str]] = ()) -> Union[Path, None]:
+    """Find a needed library the way the dynamic linker does.
+
+    RPATH is searched before LD_LIBRARY_PATH and only when there is no
+    RUNPATH, RUNPATH after it. Both may use $ORIGIN, and entries below an
+    aliased directory are searched in its copy instead. Libraries of
+    another ELF class or machine than the loader are skipped.
+
+    :param name: DT_NEEDED entry
+    :type name: str
+    :param loader: File that needs the library
+    :type loader: Path
+    :param elf: Dynamic linking details of the loader
+    :type elf: ElfDynamic
+    :param search_path: AppDir, ld.so.conf and default library directories, in order
+    :type search_path: list
+    :param aliases: Directories of RPATH and RUNPATH entries with the directory to search instead
+    :type aliases: Iterable[Tuple[str, str]]
+    :returns: Resolved library, or None if not found
+    :rtype: Union[Path, None]
+    """
+    if '/' in name:
+        candidates = [name]
     else:
-        # centos 7
-        return '--library=/lib64/libreadline.so.6 \
-                --library=/lib64/libhistory.so.6 \
-                --library=/lib64/libncurses.so.5 \
-                --library=/lib64/libncursesw.so.5'
+        origin = str(loader.parent)
+
+        def _alias(_dir: str) -> str:
+            for _source, _target in aliases:
+                if _dir == _source or _dir.startswith(_source + '/'):
+                    return _target + _dir[len(_source):]
+            return _dir
+
+        rpath = () if elf.runpath else elf.rpath
+        directories = [*map(_alias, rpath), *search_path[:len(APP_DIR_LIBRARY_DIRS)], *get_environment_library_dirs(),
+                       *map(_alias, elf.runpath), *search_path[len(APP_DIR_LIBRARY_DIRS):]]
+        candidates = [os.path.join(_dir.replace('${ORIGIN}', origin).replace('$ORIGIN', origin), name)
+                      for _dir in directories]
+    # Keep the path named after the soname, linuxdeploy copies the library under that name.
+    for _candidate in candidates:
+        path = Path(os.path.normpath(_candidate))
+        if not path.is_file():
+            continue
+        library = read_elf_dynamic(path)
+        if library is not None and (library.elf_class, library.machine) == (elf.elf_class, elf.machine):
+            return path
+    return None
 
 
-def get_linux_distro() -> str:
-    """Return distro as string.
+def get_environment_library_dirs() -> list:
+    """Return the directories of LD_LIBRARY_PATH."""
+    return [_dir for _dir in os.environ.get('LD_LIBRARY_PATH', '').split(':') if _dir]
 
-    :returns: Distro name
-    :rtype: str
+
+@functools.lru_cache(maxsize=None)
+def get_host_library_dirs(config_file: str = '/etc/ld.so.conf') -> list:
+    """Return the directories of the ld.so configuration followed by the default ones.
+
+    :param config_file: ld.so configuration, its include directives are followed
+    :type config_file: str
+    :returns: Library directories in search order
+    :rtype: list
+    """
+    def _read(_file: str) -> Iterator[str]:
+        try:
+            with open(_file) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        for _line in lines:
+            _line = _line.split('#', 1)[0].strip()
+            if _line.startswith('include '):
+                pattern = _line.split(None, 1)[1]
+                if not os.path.isabs(pattern):
+                    pattern = os.path.join(os.path.dirname(_file), pattern)
+                for _included in sorted(glob.glob(pattern)):
+                    yield from _read(_included)
+            elif _line:
+                yield _line
+
+    directories = []
+    for _dir in [*_read(config_file), *DEFAULT_LIBRARY_DIRS]:
+        if _dir not in directories:
+            directories.append(_dir)
+    return directories
+
+
+def read_elf_dynamic(path: Path) -> Union[ElfDynamic, None]:
+    """Read DT_NEEDED, DT_RPATH and DT_RUNPATH of an ELF file.
+
+    Results are memoized per file, for as long as it is not modified.
+
+    :param path: File to read
+    :type path: Path
+    :returns: Dynamic linking details, or None if the file is not ELF
+    :rtype: Union[ElfDynamic, None]
     """
-    pretty_linux_distro = run_command("cat /etc/*-release | head -1")
-    if "Debian" in pretty_linux_distro:
-        return "Debian"
-    elif "CentOS" in pretty_linux_distro:
-        return "CentOS"
-    elif any([_distro in pretty_linux_distro for _distro in ['Ubuntu', 'Pop']]):
-        return "Ubuntu"
-    return "CentOS"
+    stat = os.stat(path)
+    return _read_elf_dynamic(str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_elf_dynamic(path: str, *identity: int) -> Union[ElfDynamic, None]:
+    with open(path, mode='rb') as f:
+        if f.read(4) != b'\x7fELF' or identity[1] < 64:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse_elf_dynamic(data)
+
+
+def _parse_elf_dynamic(data: mmap.mmap) -> Union[ElfDynamic, None]:
+    elf_class, byte_order = data[4], data[5]
+    if elf_class not in (1, 2) or byte_order not in (1, 2):
+        return None
+    endian = '<' if byte_order == 1 else '>'
+    if elf_class == 2:
+        header, segment, entry = 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ'
+    else:
+        header, segment, entry = 'HHIIIIIHHHHHH', 'IIIIIIII', 'iI'
+    (_type, machine, _version, _entry, phoff, _shoff, _flags, _ehsize,
+     phentsize, phnum, _shentsize, _shnum, _shstrndx) = struct.unpack_from(endian + header, data, 16)
+
+    loads = []
+    dynamic = None
+    for _index in range(phnum):
+        fields = struct.unpack_from(endian + segment, data, phoff + _index * phentsize)
+        if elf_class == 2:
+            p_type, _p_flags, p_offset, p_vaddr, _p_paddr, p_filesz = fields[:6]
+        else:
+            p_type, p_offset, p_vaddr, _p_paddr, p_filesz = fields[:5]
+        if p_type == 1:  # PT_LOAD
+            loads.append((p_vaddr, p_filesz, p_offset))
+        elif p_type == 2:  # PT_DYNAMIC
+            dynamic = (p_offset, p_filesz)
+    if dynamic is None:
+        return ElfDynamic(elf_class, machine)
+
+    entries = []
+    entry_size = struct.calcsize(endian + entry)
+    for _offset in range(dynamic[0], dynamic[0] + dynamic[1], entry_size):
+        tag, value = struct.unpack_from(endian + entry, data, _offset)
+        if tag == 0:  # DT_NULL
+            break
+        entries.append((tag, value))
+    strtab = next((_value for _tag, _value in entries if _tag == 5), None)  # DT_STRTAB
+    strtab = next((strtab - _vaddr + _offset for _vaddr, _size, _offset in loads
+                   if strtab is not None and _vaddr <= strtab < _vaddr + _size), None)
+    if strtab is None:
+        return ElfDynamic(elf_class, machine)
+
+    def _string(_value: int) -> str:
+        start = strtab + _value
+        return data[start:data.find(b'\0', start)].decode(errors='replace')
+
+    def _paths(_tag: int) -> Tuple[str, ...]:
+        return tuple(_dir for _value in [_v for _t, _v in entries if _t == _tag]
+                     for _dir in _string(_value).split(':') if _dir)
+
+    return ElfDynamic(elf_class, machine,
+                      needed=tuple(_string(_value) for _tag, _value in entries if _tag == 1),  # DT_NEEDED
+                      rpath=_paths(15),  # DT_RPATH
+                      runpath=_paths(29))  # DT_RUNPATH
 
 
 def get_args() -> argparse.Namespace:
@@ -369,6 +2604,105 @@ def get_args() -> argparse.Namespace:
                         action='count',
                         default=0,
                         help='Increase output verbosity.')
+    parser.add_argument('--cache-dir',
+                        default=str(DEFAULT_CACHE_DIR),
+                        help='Directory of the build artifact cache. (default=%(default)s)')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=DEFAULT_CACHE_SIZE,
+                        help='Maximum size of the build artifact cache in MiB. (default=%(default)s)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        default=False,
+                        help='Always build every stage, bypassing the artifact cache.')
+    parser.add_argument('--profile',
+                        choices=sorted(BUILD_PROFILES),
+                        default=DEFAULT_BUILD_PROFILE,
+                        help='Interpreter build profile. (default=%(default)s)')
+    parser.add_argument('--sqlite-profile',
+                        choices=sorted(SQLITE_PROFILES),
+                        default=DEFAULT_SQLITE_PROFILE,
+                        help='sqlite compile profile. (default=%(default)s)')
+    parser.add_argument('--openssl-options',
+                        default=' '.join(OPENSSL_OPTIONS),
+                        help="Options passed to openssl's config. (default=%(default)s)")
+    parser.add_argument('--openssl-speed',
+                        action='store_true',
+                        default=False,
+                        help='Compare openssl speed of the built openssl with the openssl of the previous '
+                             'build, recorded in the artifact cache, and add the results to the build report.')
+    parser.add_argument('--pgo-task',
+                        default=None,
+                        help='Arguments of the PGO training run for the optimized profile, '
+                             "e.g. '-m test --pgo test_json test_re'. (default=cpython's task)")
+    parser.add_argument('--report',
+                        default=None,
+                        help='Write a JSON report with the timeline of the build to this file.')
+    parser.add_argument('--log-dir',
+                        default=str(PROJECT_DIR.joinpath('build-logs')),
+                        help='Directory of the per-stage command logs. (default=%(default)s)')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        default=False,
+                        help='Run cpython regression tests and the pytest suite against the AppDir before it is '
+                             'pruned and packed, failing the build on the first failure.')
+    parser.add_argument('--verify-tests',
+                        default=' '.join(VERIFY_TESTS),
+                        help='regrtest modules the verify stage runs in parallel. (default=%(default)s)')
+    parser.add_argument('--verify-pytest-args',
+                        default=VERIFY_PYTEST_ARGS,
+                        help='Extra arguments of the pytest run of the verify stage. (default=%(default)s)')
+    parser.add_argument('--verify-results',
+                        default=str(PROJECT_DIR.joinpath('verify-results')),
+                        help='Directory of the JUnit XML results of the verify stage. (default=%(default)s)')
+    parser.add_argument('--log-tail',
+                        type=int,
+                        default=DEFAULT_LOG_TAIL,
+                        help='Number of log lines shown when a command fails. (default=%(default)s)')
+    parser.add_argument('--invalidation-mode',
+                        choices=INVALIDATION_MODES,
+                        default=DEFAULT_INVALIDATION_MODE,
+                        help='Invalidation mode of the precompiled bytecode. (default=%(default)s)')
+    parser.add_argument('--zip-stdlib',
+                        action='store_true',
+                        default=False,
+                        help='Pack the pure-python stdlib into lib/pythonXY.zip.')
+    parser.add_argument('--prune-manifest',
+                        default=None,
+                        help='Manifest of what to prune from the AppDir. (default=RESOURCES_DIR/prune.json)')
+    parser.add_argument('--no-prune',
+                        action='store_true',
+                        default=False,
+                        help='Package the AppDir without pruning, stripping or deduplicating it.')
+    parser.add_argument('--compression',
+                        choices=list(COMPRESSION_PROFILES),
+                        default=DEFAULT_COMPRESSION_PROFILE,
+                        help='Squashfs compression profile of the AppImage. (default=%(default)s)')
+    parser.add_argument('--compare-compression',
+                        action='store_true',
+                        default=False,
+                        help='Build the AppImage with every compression profile and compare size, '
+                             'cold start and full read time.')
+    parser.add_argument('--work-dir',
+                        default=None,
+                        help='Keep unpacked and configured source trees in this directory between runs.')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Jobs shared by every make, bytecode compilation and regrtest run of the build, '
+                             'including interpreters built in parallel (default: %(default)s).')
+    parser.add_argument('--no-ccache',
+                        action='store_true',
+                        default=False,
+                        help='Do not route compiles through ccache, even when it is installed.')
+    parser.add_argument('--wheelhouse-requirements',
+                        metavar='FILE',
+                        help='Build wheels of the requirements in FILE into the wheelhouse for '
+                             'offline installs into appimage_venv environments.')
+    parser.add_argument('--wheelhouse',
+                        metavar='DIR',
+                        default=DEFAULT_CACHE_DIR.joinpath('wheelhouse'),
+                        help='Directory of the wheelhouse, shared between builds (default: %(default)s).')
     return parser.parse_args()
 
 
@@ -2,48 +2,118 @@ import argparse
 import json
 import logging
 import logging.config
+import os
 import re
 import urllib
+import urllib.error
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
 
 URI_BASE = 'https://api.github.com/repos/python/cpython/tags'
 
 CLEAN_REGEX = re.compile(r'^v?3\.(?P<minor>[0-9]+)\.(?P<patch>[0-9]+)$')  # Skip alpha, beta, release candidates, etc
 
+DEFAULT_CACHE_FILE = Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser().joinpath(
+    'python-appimage', 'cpython-tags.json')
 
-# def _basedir_finder():
-#     return Path(__file__).parent
-# 
-# 
-# def get_data_file(minor_version, basedir_finder=_basedir_finder):
-#     base = basedir_finder()
-#     filename = 'version_list3.{0}.json'.format(minor_version)
-#     return base.joinpath(filename)
-# 
-# 
-# def read_data(data_file_path):
-#     try:
-#         with data_file_path.open() as f:
-#             return json.load(f)
-#     except FileNotFoundError:
-#         return []
-# 
-# 
-# def write_data(data, data_file_path):
-#     with data_file_path.open('w') as f:
-#         json.dump(data, f)
-# 
-
-def get_versions(uri: str = URI_BASE, limit: int = 50):
-    return
-
-
-def _get_api_json(uri: str, per_page: int = 1, page: int = 1) -> json:
+LINK_LAST_REGEX = re.compile(r'<(?P<uri>[^>]+)>;\s*rel="last"')
+
+
+def read_data(data_file_path: Path) -> dict:
+    """Read the cached tag pages.
+
+    Returns:
+        dict: Page URI to its ETag, tags and number of the last page
+    """
+    try:
+        with data_file_path.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_data(data: dict, data_file_path: Path) -> None:
+    """Replace the cached tag pages, atomically so concurrent runs never read a partial file."""
+    data_file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = data_file_path.with_name(f'{data_file_path.name}.tmp-{os.getpid()}')
+    with tmp_path.open('w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, data_file_path)
+
+
+def get_versions(uri: str = URI_BASE,
+                 per_page: int = 100,
+                 max_workers: int = 8,
+                 cache_file: Optional[Path] = DEFAULT_CACHE_FILE) -> List[str]:
+    """Return the names of every tag of the repository.
+
+    The first page tells how many pages there are, the rest are fetched
+    concurrently. Every page is requested conditionally on the ETag cached
+    from the previous run, so unchanged pages are answered with a 304 and
+    come from the cache.
+
+    Keyword Arguments:
+        uri (str): Tags endpoint of the GitHub API
+        per_page (int): Tags per page
+        max_workers (int): Pages fetched at once
+        cache_file (Path): JSON file caching the pages, None to disable
+
+    Returns:
+        list: Tag names, newest first
+    """
+    cache = read_data(cache_file) if cache_file is not None else {}
+    first = _get_api_json(uri, per_page=per_page, page=1, cache=cache)
+    pages = [first]
+    if first['last'] > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages.extend(executor.map(lambda _page: _get_api_json(uri, per_page=per_page, page=_page, cache=cache),
+                                      range(2, first['last'] + 1)))
+    if cache_file is not None:
+        write_data(cache, cache_file)
+    return [_tag for _page in pages for _tag in _page['tags']]
+
+
+def _get_api_json(uri: str, per_page: int = 100, page: int = 1, cache: Optional[dict] = None) -> dict:
+    """Fetch one page of tags, or take it from the cache when it has not changed.
+
+    The page is stored in the cache, keyed by its URI.
+
+    Returns:
+        dict: The page's ETag, tag names and number of the last page
+    """
+    cache = cache if cache is not None else {}
     params = urllib.parse.urlencode({'per_page': per_page, 'page': page})
-    with urllib.request.urlopen(f'{uri}?{params}') as f:
-        content = f.read().decode()
-    return json.loads(content)
+    page_uri = f'{uri}?{params}'
+    request = urllib.request.Request(page_uri, headers={'Accept': 'application/vnd.github+json'})
+    if os.environ.get('GITHUB_TOKEN'):
+        request.add_header('Authorization', f'Bearer {os.environ["GITHUB_TOKEN"]}')
+    cached = cache.get(page_uri)
+    if cached and cached.get('etag'):
+        request.add_header('If-None-Match', cached['etag'])
+
+    try:
+        with urllib.request.urlopen(request) as f:
+            content = json.loads(f.read().decode())
+            etag = f.headers.get('ETag')
+            link = f.headers.get('Link', '')
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            logging.debug(f'{page_uri} not modified')
+            return cached
+        raise
+
+    match = LINK_LAST_REGEX.search(link)
+    if match:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(match['uri']).query)
+        last = int(query['page'][0])
+    else:
+        last = page
+    entry = {'etag': etag, 'tags': [_tag['name'] for _tag in content], 'last': last}
+    cache[page_uri] = entry
+    return entry
 
 
 def clean_versions(versions):
@@ -61,7 +131,10 @@ def filter_on_minor(versions, only_match):
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Get the latest patch version of Python for a given minor version.')
-    parser.add_argument('-v', dest='version', type=int, default=8, help='The minor version to look for. (default=8)')
+    parser.add_argument('-v', dest='versions', type=int, nargs='+', default=[8],
+                        help='The minor versions to look for. (default=8)')
+    parser.add_argument('--no-cache', dest='cache_file', action='store_const', const=None, default=DEFAULT_CACHE_FILE,
+                        help='Neither read nor update the cache of tag pages.')
 
     return parser.parse_args()
 
@@ -104,18 +177,26 @@ def configure_logging(verbosity: int = 0) -> None:
     logging.config.dictConfig(config)
 
 
-def main(minor_version):
-#    data_file_path = get_data_file(minor_version=minor_version)
-#    data = read_data(data_file_path)
+def get_latest_versions(minor_versions, tags) -> dict:
+    """Return the latest patch release of each minor version found in tags."""
+    versions = list(clean_versions(tags))
+    latest = {}
+    for minor_version in minor_versions:
+        matches = sorted(filter_on_minor(versions, only_match=minor_version), reverse=True)
+        latest[minor_version] = '{0}.{1}.{2}'.format(*matches[0]) if matches else None
+    return latest
+
 
-    versions = clean_versions(get_versions())
-    versions = sorted(filter_on_minor(versions, only_match=minor_version), reverse=True)
-    versions = ['{0}.{1}.{2}'.format(*version) for version in versions]
-    print(versions[0])
-#    if (data and versions) and data != versions and versions[0] > data[0]:
-#        write_data(versions, data_file_path)
+def main(minor_versions, cache_file=DEFAULT_CACHE_FILE):
+    tags = get_versions(cache_file=cache_file)
+    for minor_version, version in get_latest_versions(minor_versions, tags).items():
+        if version is None:
+            logging.error(f'No release of 3.{minor_version} found')
+            continue
+        print(version)
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args.version)
+    configure_logging()
+    main(args.versions, cache_file=args.cache_file)
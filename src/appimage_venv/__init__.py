@@ -1,14 +1,30 @@
 """AppImage wrapper module for creating virtual environments with the venv
 module."""
+import ensurepip
+import fcntl
+import functools
+import json
 import logging
+import mmap
 import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from venv import EnvBuilder
 from types import SimpleNamespace
 
 CORE_VENV_DEPS = ('pip', 'setuptools')
+# ioctl request to share the extents of one file with another (reflink)
+FICLONE = 0x40049409
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home().joinpath('.cache')), 'appimage_venv')
+# Build details of the AppImage, see build-appimage.py
+MANIFEST_FILE = Path(sys.base_prefix, 'share', 'python-appimage', 'manifest.json')
 logger = logging.getLogger(__name__)
+_template_lock = threading.Lock()
 
 try:
     APPIMAGE_PATH = os.environ['APPIMAGE']
@@ -18,10 +34,114 @@ except KeyError:
     sys.exit(2)
 
 
+def get_wheelhouse():
+    """Return the wheelhouse built with the AppImage, if it is present.
+
+    APPIMAGE_VENV_WHEELHOUSE takes precedence over the location recorded in
+    the manifest of the AppImage.
+    """
+    wheelhouse = os.environ.get('APPIMAGE_VENV_WHEELHOUSE')
+    if wheelhouse is None:
+        try:
+            with MANIFEST_FILE.open() as f:
+                wheelhouse = json.load(f).get('wheelhouse', {}).get('path')
+        except (OSError, ValueError):
+            return None
+    if wheelhouse and os.path.isdir(wheelhouse):
+        return os.path.abspath(wheelhouse)
+    return None
+
+
+def get_template_dir() -> Path:
+    """Return the directory of the template venv for this interpreter and
+    pip version."""
+    version = '%d.%d.%d' % sys.version_info[:3]
+    return CACHE_DIR.joinpath(f'python{version}-pip{ensurepip.version()}')
+
+
+def clone_file(source: Path, destination: Path) -> None:
+    """Clone a file as a hardlink, a reflink or, failing both, a copy."""
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    try:
+        with source.open(mode='rb') as _in, destination.open(mode='wb') as _out:
+            fcntl.ioctl(_out.fileno(), FICLONE, _in.fileno())
+        shutil.copystat(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def clone_tree(source: Path, destination: Path) -> None:
+    """Recreate a directory tree, cloning its files with clone_file."""
+    shutil.copytree(source, destination, symlinks=True, copy_function=clone_file, dirs_exist_ok=True)
+
+
 class AppImageEnvBuilder(EnvBuilder):
 
-    def __init__(self, **kwargs):
+    def __init__(self, use_template: bool = True, wheelhouse: str = None,
+                 offline: bool = False, **kwargs):
         super().__init__(**kwargs)
+        self.use_template = use_template
+        self.wheelhouse = wheelhouse if wheelhouse is not None else get_wheelhouse()
+        self.offline = offline
+
+    def _setup_pip(self, context: SimpleNamespace) -> None:
+        """Install pip by cloning it from the template venv.
+
+        ensurepip unpacks its wheels in a subprocess every time, so it
+        only runs once per interpreter and pip version, to build the
+        template. An upgrade is still left to ensurepip.
+        """
+        if not self.use_template or self.upgrade:
+            super()._setup_pip(context)
+            return
+        template = self.get_template()
+        origin = template.joinpath('origin').read_text()
+        site_packages = Path('lib', 'python%d.%d' % sys.version_info[:2], 'site-packages')
+        clone_tree(template.joinpath('venv', site_packages), Path(context.env_dir, site_packages))
+
+        # The console scripts of pip point at the interpreter of the template
+        bin_path = Path(context.bin_path)
+        for _script in template.joinpath('venv', context.bin_name).iterdir():
+            destination = bin_path.joinpath(_script.name)
+            if _script.is_symlink() or destination.exists():
+                continue
+            destination.write_text(_script.read_text().replace(origin, context.env_dir))
+            shutil.copymode(_script, destination)
+        logger.debug(f'Cloned pip from {template}')
+
+    def get_template(self) -> Path:
+        """Return the template venv for this interpreter and pip version,
+        creating it first if needed.
+
+        The template is built in a temporary directory and renamed into
+        place, so concurrent creations never see a partial template.
+        """
+        template = get_template_dir()
+        with _template_lock:
+            if not template.joinpath('origin').exists():
+                self._create_template(template)
+        return template
+
+    def _create_template(self, template: Path) -> None:
+        logger.info(f'Creating venv template {template}')
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix='.tmp-', dir=CACHE_DIR))
+        try:
+            env_dir = staging.joinpath('venv')
+            EnvBuilder(symlinks=self.symlinks, with_pip=True).create(env_dir)
+            staging.joinpath('origin').write_text(str(env_dir))
+            try:
+                staging.rename(template)
+            except OSError:
+                # Another process finished the template first
+                if not template.joinpath('origin').exists():
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
 
     def modify_venv(self, env_dir: str) -> None:
         """Modify venv that has been created to run properly from an
@@ -36,22 +156,30 @@ class AppImageEnvBuilder(EnvBuilder):
         """Returns a context object that holds paths required for modifying the
         Venv to be used with an AppImage.
 
-        Consequently to get the original context,
-        EnvBuilder.ensure_directories is called. This shouldn't pose a
-        problem because the environment was just created, but beware
-        this is a side-effect.
+        The paths are derived the same way EnvBuilder.ensure_directories
+        does, without touching the file system, so one builder can modify
+        several environments at once.
         """
-        context = self.ensure_directories(env_dir)
+        context = SimpleNamespace()
         context.env_dir = os.path.abspath(env_dir)
+        context.env_name = os.path.basename(context.env_dir)
+        prompt = self.prompt if self.prompt is not None else context.env_name
+        context.prompt = '(%s) ' % prompt
         executable = APPIMAGE_PATH
         dirname, exename = os.path.split(os.path.abspath(executable))
         context.executable = executable
         context.python_dir = dirname
         context.python_exe = exename
-        context.bin_full_path = os.path.abspath(context.bin_path)
+        context.bin_name = 'bin'
+        context.bin_path = os.path.join(context.env_dir, context.bin_name)
+        context.bin_full_path = context.bin_path
+        context.env_exe = os.path.join(context.bin_path, os.path.basename(sys._base_executable))
         context.lib_path = os.path.join(
             context.env_dir, 'lib', 'python%d.%d' % sys.version_info[:2], 'site-packages'
         )
+        context.find_links = self.wheelhouse or ''
+        context.cache_dir = str(CACHE_DIR.joinpath('pip'))
+        context.no_index = 'true' if self.offline else ''
         return context
 
     @staticmethod
@@ -92,12 +220,18 @@ class AppImageEnvBuilder(EnvBuilder):
         windows_activate.unlink(missing_ok=True)
 
     def write_pipconf(self, context: SimpleNamespace):
-        """Write out pip.conf in the root of the $VENV."""
+        """Write out pip.conf in the root of the $VENV.
+
+        Settings left without a value, e.g. find-links without a
+        wheelhouse, are dropped.
+        """
         _template = Path(__file__).absolute().parent.joinpath('configs', 'pip.conf')
         _destination = Path(context.env_dir).joinpath('pip.conf')
         with _template.open(mode='r') as _in, _destination.open(mode='w') as _out:
             for _in_line in _in:
                 _out_line = self.replace_text(_in_line, context)
+                if _out_line.rstrip().endswith('='):
+                    continue
                 _out.write(_out_line)
 
     @staticmethod
@@ -107,22 +241,130 @@ class AppImageEnvBuilder(EnvBuilder):
         line = line.replace('__VENV_LIB_DIR__', context.lib_path)
         line = line.replace('__VENV_BIN_NAME__', context.bin_full_path)
         line = line.replace('__VENV_PROMPT__', context.prompt)
+        line = line.replace('__VENV_FIND_LINKS__', context.find_links)
+        line = line.replace('__VENV_CACHE_DIR__', context.cache_dir)
+        line = line.replace('__VENV_NO_INDEX__', context.no_index)
         return line
 
 
 def create(env_dir, system_site_packages=False, clear=False,
-           symlinks=False, with_pip=False, prompt=None, upgrade_deps=False):
+           symlinks=False, with_pip=False, prompt=None, upgrade_deps=False,
+           use_template=True):
     """Create a virtual environment in a directory."""
     builder = AppImageEnvBuilder(
         system_site_packages=system_site_packages,
         clear=clear, symlinks=symlinks, with_pip=with_pip,
-        prompt=prompt, upgrade_deps=upgrade_deps
+        prompt=prompt, upgrade_deps=upgrade_deps,
+        use_template=use_template
     )
     builder.create(env_dir)
     builder.modify_venv(env_dir)
 
 
+def create_all(make_builder, dirs, jobs=1):
+    """Create and modify environments in several directories, up to jobs
+    at a time.
+
+    make_builder is called for every directory, each environment is built
+    by a builder of its own, since EnvBuilder keeps state while it runs.
+    A failure does not stop the others, the errors are returned keyed by
+    directory.
+    """
+    def _create(env_dir):
+        builder = make_builder()
+        builder.create(env_dir)
+        builder.modify_venv(env_dir)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {d: executor.submit(_create, d) for d in dirs}
+    for d, future in futures.items():
+        if future.exception() is not None:
+            failures[d] = future.exception()
+    return failures
+
+
+def relocate(source, destination, move=False):
+    """Clone or move an environment and rewrite the paths embedded in it.
+
+    Files are cloned with clone_file. Every file is then scanned for the
+    absolute path of the source, and only the text files that contain it
+    are rewritten, through a new file so links to the original are broken.
+    Files with NUL bytes, such as bytecode, are left alone; importlib
+    corrects the file names in bytecode when it is loaded. Symlinks into
+    the source are retargeted.
+
+    Returns the number of files rewritten and symlinks retargeted.
+    """
+    source = os.path.abspath(source)
+    destination = os.path.abspath(destination)
+    if not os.path.isfile(os.path.join(source, 'pyvenv.cfg')):
+        raise ValueError('%s is not a virtual environment.' % source)
+    if os.path.lexists(destination):
+        raise ValueError('%s already exists.' % destination)
+    if move:
+        shutil.move(source, destination)
+    else:
+        clone_tree(Path(source), Path(destination))
+
+    old, new = os.fsencode(source), os.fsencode(destination)
+    pattern = re.compile(rb'(?<![\w.-])' + re.escape(old) + rb'(?![\w.-])')
+    rewritten = retargeted = 0
+    for _root, _dirs, _files in os.walk(destination):
+        for _name in _dirs + _files:
+            path = os.path.join(_root, _name)
+            if os.path.islink(path):
+                target = os.fsencode(os.readlink(path))
+                if pattern.match(target):
+                    os.unlink(path)
+                    os.symlink(pattern.sub(lambda _match: new, target, count=1), path)
+                    retargeted += 1
+            elif _name in _files and _rewrite_file(path, pattern, new):
+                rewritten += 1
+    logger.info(f'Relocated {source} to {destination}: rewrote {rewritten} files, retargeted {retargeted} symlinks')
+    return rewritten, retargeted
+
+
+def _rewrite_file(path, pattern, replacement):
+    """Replace pattern in a text file, writing a new file only if it matches."""
+    if os.path.getsize(path) == 0:
+        return False
+    with open(path, mode='rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if pattern.search(m) is None or m.find(b'\0') != -1:
+            return False
+        content = pattern.sub(lambda _match: replacement, m)
+    staging = path + '.relocate'
+    with open(staging, mode='wb') as f:
+        f.write(content)
+    shutil.copystat(path, staging)
+    os.replace(staging, path)
+    return True
+
+
+def relocate_main(command, args):
+    """Run the clone and relocate commands."""
+    import argparse
+
+    action = 'Clones' if command == 'clone' else 'Moves'
+    parser = argparse.ArgumentParser(prog='%s %s' % (__name__, command),
+                                     description=action + (' a virtual '
+                                                           'environment to a new '
+                                                           'directory, rewriting the '
+                                                           'paths embedded in its '
+                                                           'files.'))
+    parser.add_argument('source', metavar='SRC',
+                        help='The environment to ' + command + '.')
+    parser.add_argument('destination', metavar='DST',
+                        help='The new directory, it must not exist yet.')
+    options = parser.parse_args(args)
+    relocate(options.source, options.destination, move=command == 'relocate')
+
+
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] in ('clone', 'relocate'):
+        return relocate_main(args[0], args[1:])
     compatible = True
     if sys.version_info < (3, 3):
         compatible = False
@@ -179,6 +421,21 @@ def main(args=None):
                             help='Skips installing or upgrading pip in the '
                                  'virtual environment (pip is bootstrapped '
                                  'by default)')
+        parser.add_argument('--no-template', dest='use_template',
+                            default=True, action='store_false',
+                            help='Bootstrap pip with ensurepip instead of '
+                                 'cloning it from the cached template '
+                                 'environment.')
+        parser.add_argument('--wheelhouse',
+                            help='Directory of wheels pip should install '
+                                 'from, defaults to the wheelhouse built '
+                                 'with the AppImage.')
+        parser.add_argument('--offline', default=False, action='store_true',
+                            help='Configure pip to never use the package '
+                                 'index, only the wheelhouse.')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of environments to create at '
+                                 'once (default: %(default)s).')
         parser.add_argument('--prompt',
                             help='Provides an alternative prompt prefix for '
                                  'this environment.')
@@ -189,17 +446,26 @@ def main(args=None):
         options = parser.parse_args(args)
         if options.upgrade and options.clear:
             raise ValueError('you cannot supply --upgrade and --clear together.')
-        builder = AppImageEnvBuilder(
+        if options.jobs < 1:
+            raise ValueError('--jobs must be at least 1.')
+        make_builder = functools.partial(
+            AppImageEnvBuilder,
             system_site_packages=options.system_site,
             clear=options.clear,
             symlinks=options.symlinks,
             upgrade=options.upgrade,
             with_pip=options.with_pip,
             prompt=options.prompt,
-            upgrade_deps=options.upgrade_deps)
-        for d in options.dirs:
-            builder.create(d)
-            builder.modify_venv(d)
+            upgrade_deps=options.upgrade_deps,
+            use_template=options.use_template,
+            wheelhouse=options.wheelhouse,
+            offline=options.offline)
+        failures = create_all(make_builder, options.dirs, options.jobs)
+        for d, e in failures.items():
+            print('Error: %s: %s' % (d, e), file=sys.stderr)
+        if failures:
+            raise RuntimeError('%d of %d environments could not be created.'
+                               % (len(failures), len(options.dirs)))
 
 
 if __name__ == '__main__':
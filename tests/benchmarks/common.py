@@ -0,0 +1,173 @@
+"""Helpers shared by the benchmark suites of the built AppImage.
+
+Every suite writes the same JSON document: a list of metrics, each holding
+the value measured for the AppImage interpreter and for the reference
+interpreter, so results can be compared against a stored baseline.
+"""
+import argparse
+import fnmatch
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+FORMAT_VERSION = 1
+INTERPRETERS = ('appimage', 'reference')
+
+
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments every benchmark suite accepts."""
+    parser.add_argument('appimage', help='Path to the built AppImage')
+    parser.add_argument('--reference', default=sys.executable,
+                        help='Reference interpreter to compare against. (default=%(default)s)')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file.')
+    parser.add_argument('--baseline', default=None,
+                        help='Results of an earlier run to check for regressions against.')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative change against the baseline counted as a regression. (default=%(default)s)')
+    parser.add_argument('--metric-threshold', action='append', default=[], metavar='PATTERN=FRACTION',
+                        type=parse_metric_threshold,
+                        help='Threshold of the metrics matching a glob pattern, e.g. tls.*=0.2, overriding '
+                             '--threshold. May be repeated, the last matching pattern wins.')
+
+
+def parse_metric_threshold(value: str) -> tuple:
+    """Parse a PATTERN=FRACTION argument."""
+    pattern, separator, fraction = value.rpartition('=')
+    try:
+        if not separator or not pattern:
+            raise ValueError
+        return pattern, float(fraction)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected PATTERN=FRACTION, got {value!r}')
+
+
+def interpreter_commands(args: argparse.Namespace) -> dict:
+    """Return the command launching each interpreter."""
+    return {
+        'appimage': [os.path.abspath(args.appimage)],
+        'reference': [args.reference],
+    }
+
+
+def interpreter_version(command: list) -> str:
+    """Return the full version string of an interpreter."""
+    result = subprocess.run(command + ['-c', 'import sys; print(sys.version)'],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+def time_command(command: list, **kwargs) -> float:
+    """Run a command to completion and return its wall clock time in seconds."""
+    started = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True, **kwargs)
+    return time.perf_counter() - started
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Return the nearest-rank percentile of the samples."""
+    ordered = sorted(samples)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(samples: list) -> dict:
+    """Return the statistics reported for a series of samples."""
+    return {
+        'min': min(samples),
+        'p50': statistics.median(samples),
+        'p90': percentile(samples, 0.90),
+        'p99': percentile(samples, 0.99),
+        'max': max(samples),
+        'mean': statistics.fmean(samples),
+    }
+
+
+def metric(name: str, unit: str, values: dict, better: str = 'lower') -> dict:
+    """Return a metric record, values are keyed by interpreter name."""
+    return {
+        'name': name,
+        'unit': unit,
+        'better': better,
+        'values': {_interpreter: values.get(_interpreter) for _interpreter in INTERPRETERS},
+    }
+
+
+def build_results(suite: str, commands: dict, metrics: list, **extra) -> dict:
+    """Return the JSON document of a benchmark run."""
+    return {
+        'format': FORMAT_VERSION,
+        'suite': suite,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'host': {
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'platform': platform.platform(),
+        },
+        'interpreters': {
+            _name: {'command': _command, 'version': interpreter_version(_command)}
+            for _name, _command in commands.items()
+        },
+        'metrics': metrics,
+        **extra,
+    }
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float, metric_thresholds: list = ()) -> list:
+    """Return a description of every AppImage metric worse than the baseline by more than its threshold.
+
+    metric_thresholds holds (pattern, threshold) pairs overriding threshold for the metrics they match.
+    """
+    previous = {_metric['name']: _metric for _metric in baseline.get('metrics', [])}
+    regressions = []
+    for _metric in results['metrics']:
+        if _metric['name'] not in previous:
+            continue
+        value = _metric['values']['appimage']
+        before = previous[_metric['name']]['values']['appimage']
+        if value is None or not before:
+            continue
+        change = (value - before) / before
+        if _metric['better'] == 'higher':
+            change = -change
+        limit = threshold
+        for _pattern, _threshold in metric_thresholds:
+            if fnmatch.fnmatchcase(_metric['name'], _pattern):
+                limit = _threshold
+        if change > limit:
+            regressions.append(f"{_metric['name']}: {before:.3f} -> {value:.3f} {_metric['unit']} "
+                               f'({change:+.1%})')
+    return regressions
+
+
+def print_table(results: dict) -> None:
+    """Print the metrics side by side for both interpreters."""
+    print(f'{"metric":<40} {"appimage":>12} {"reference":>12} {"unit":>6}')
+    for _metric in results['metrics']:
+        values = [_metric['values'][_interpreter] for _interpreter in INTERPRETERS]
+        cells = ['-' if _value is None else f'{_value:.3f}' for _value in values]
+        print(f"{_metric['name']:<40} {cells[0]:>12} {cells[1]:>12} {_metric['unit']:>6}")
+
+
+def finish(args: argparse.Namespace, results: dict) -> int:
+    """Print and write the results, then gate them on the baseline.
+
+    :returns: Exit status, 1 when a regression was found
+    """
+    print_table(results)
+    if args.output:
+        with open(args.output, mode='w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold, args.metric_threshold)
+        for _regression in regressions:
+            print(f'Regression: {_regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,110 @@
+"""Startup and import latency benchmarks of the built AppImage.
+
+Compares launching the AppImage, through its AppRun, against a reference
+interpreter:
+
+* cold launch, after dropping the page cache when permitted
+* warm ``-c pass`` launch latency percentiles
+* ``-X importtime`` breakdowns of ssl, sqlite3 and appimage_venv
+
+Example:
+    python3 tests/benchmarks/startup.py ./python3.10.0.AppImage --output startup.json
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+import common
+
+IMPORTS = ('ssl', 'sqlite3', 'appimage_venv')
+
+
+def drop_caches() -> bool:
+    """Drop the page cache, returns False when not permitted."""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', mode='w') as f:
+            f.write('3\n')
+    except OSError:
+        return False
+    return True
+
+
+def parse_importtime(stderr: str, module: str) -> dict:
+    """Parse -X importtime output into the timings of a module.
+
+    :returns: Self and cumulative microseconds of the module and the number of modules imported
+    """
+    entries = []
+    for _line in stderr.splitlines():
+        if not _line.startswith('import time:') or 'self [us]' in _line:
+            continue
+        own, cumulative, name = _line[len('import time:'):].split('|', 2)
+        entries.append((name.strip(), int(own), int(cumulative)))
+    timing = {'self_us': None, 'cumulative_us': None, 'modules': len(entries)}
+    for _name, _own, _cumulative in entries:
+        if _name == module:
+            timing['self_us'], timing['cumulative_us'] = _own, _cumulative
+    return timing
+
+
+def measure_import(command: list, module: str, runs: int) -> dict:
+    """Return the median -X importtime timings of importing a module in a fresh interpreter."""
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(command + ['-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return {'self_us': None, 'cumulative_us': None, 'modules': None}
+        samples.append(parse_importtime(result.stderr, module))
+    return {
+        _key: statistics.median(_sample[_key] for _sample in samples)
+        for _key in ('self_us', 'cumulative_us', 'modules')
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    commands = common.interpreter_commands(args)
+    measured = {}
+    caches_dropped = True
+    for _name, _command in commands.items():
+        caches_dropped = drop_caches() and caches_dropped
+        cold = common.time_command(_command + ['-c', 'pass']) * 1000
+        for _ in range(args.warmup):
+            common.time_command(_command + ['-c', 'pass'])
+        warm = [common.time_command(_command + ['-c', 'pass']) * 1000 for _ in range(args.runs)]
+        imports = {_module: measure_import(_command, _module, args.import_runs) for _module in IMPORTS}
+        measured[_name] = {'cold': cold, 'warm': common.summarize(warm), 'imports': imports}
+
+    def _values(getter):
+        return {_name: getter(_measured) for _name, _measured in measured.items()}
+
+    metrics = [common.metric('launch.cold', 'ms', _values(lambda _m: _m['cold']))]
+    for _stat in ('min', 'p50', 'p90', 'p99', 'max', 'mean'):
+        metrics.append(common.metric(f'launch.warm.{_stat}', 'ms', _values(lambda _m: _m['warm'][_stat])))
+    for _module in IMPORTS:
+        for _key, _unit in (('cumulative_us', 'us'), ('self_us', 'us'), ('modules', 'count')):
+            metrics.append(common.metric(f'import.{_module}.{_key.replace("_us", "")}', _unit,
+                                         _values(lambda _m: _m['imports'][_module][_key])))
+    return common.build_results('startup', commands, metrics,
+                                parameters={'runs': args.runs, 'warmup': args.warmup,
+                                            'import_runs': args.import_runs,
+                                            'cold_caches_dropped': caches_dropped})
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Startup and import latency benchmarks of the built AppImage.')
+    common.add_common_arguments(parser)
+    parser.add_argument('--runs', type=int, default=50, help='Number of warm launches. (default=%(default)s)')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='Launches discarded before measuring. (default=%(default)s)')
+    parser.add_argument('--import-runs', type=int, default=10,
+                        help='Number of -X importtime runs per module. (default=%(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    sys.exit(common.finish(arguments, run(arguments)))
@@ -0,0 +1,230 @@
+"""Runtime throughput benchmarks of the libraries built into the AppImage.
+
+Compares the statically linked OpenSSL and the bundled SQLite of the
+AppImage against a reference interpreter, entirely offline:
+
+* TLS handshakes and bulk transfer over loopback, with tests/resources/cert.pem
+* hashlib digests of in-memory data
+* sqlite3 bulk insert, indexed point queries and full-text search
+
+Each workload runs inside the interpreter being measured, by running this
+script in it with ``--worker``.
+
+Example:
+    python3 tests/benchmarks/throughput.py ./python3.10.0.AppImage --output throughput.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import common
+
+CERT_FILE = Path(__file__).absolute().parents[1].joinpath('resources', 'cert.pem')
+DIGESTS = ('md5', 'sha1', 'sha256', 'sha512', 'blake2b', 'sha3_256')
+CHUNK_SIZE = 1 << 16
+WORDS = ('python', 'appimage', 'sqlite', 'openssl', 'squashfs', 'interpreter', 'virtual', 'environment',
+         'bytecode', 'library', 'linker', 'module', 'package', 'wheel', 'cache', 'benchmark')
+
+
+def serve_tls(listener: socket.socket, context: ssl.SSLContext) -> None:
+    """Accept TLS connections until the listener is closed, draining whatever each client sends."""
+    while True:
+        try:
+            connection, _address = listener.accept()
+        except OSError:
+            return
+        try:
+            with context.wrap_socket(connection, server_side=True) as _tls:
+                while _tls.recv(CHUNK_SIZE):
+                    pass
+        except (OSError, ssl.SSLError):
+            pass
+
+
+def measure_tls(cert_file: str, handshakes: int, transfer_mib: int) -> dict:
+    """Return TLS handshakes per second and bulk transfer MiB/s over loopback."""
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert_file)
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        address = listener.getsockname()
+        server = threading.Thread(target=serve_tls, args=(listener, server_context), daemon=True)
+        server.start()
+
+        started = time.perf_counter()
+        for _ in range(handshakes):
+            with socket.create_connection(address) as _connection:
+                with client_context.wrap_socket(_connection) as _tls:
+                    version, cipher = _tls.version(), _tls.cipher()[0]
+        handshake_rate = handshakes / (time.perf_counter() - started)
+
+        payload = os.urandom(CHUNK_SIZE)
+        with socket.create_connection(address) as _connection:
+            with client_context.wrap_socket(_connection) as _tls:
+                started = time.perf_counter()
+                for _ in range(transfer_mib * (1 << 20) // CHUNK_SIZE):
+                    _tls.sendall(payload)
+                transfer_rate = transfer_mib / (time.perf_counter() - started)
+
+    return {'handshake': handshake_rate, 'bulk': transfer_rate, 'version': version, 'cipher': cipher}
+
+
+def measure_hashlib(size_mib: int) -> dict:
+    """Return MiB/s of each digest over in-memory data."""
+    import hashlib
+
+    data = os.urandom(1 << 20)
+    rates = {}
+    for _name in DIGESTS:
+        digest = hashlib.new(_name)
+        started = time.perf_counter()
+        for _ in range(size_mib):
+            digest.update(data)
+        digest.digest()
+        rates[_name] = size_mib / (time.perf_counter() - started)
+    return rates
+
+
+def measure_sqlite(rows: int, queries: int) -> dict:
+    """Return bulk insert rows/s, indexed queries/s and full-text queries/s of a file database."""
+    generator = random.Random(42)
+    records = [(_id, generator.randrange(rows), ' '.join(generator.choices(WORDS, k=12))) for _id in range(rows)]
+    keys = [generator.randrange(rows) for _ in range(queries)]
+    terms = [' '.join(generator.sample(WORDS, 2)) for _ in range(queries)]
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        connection = sqlite3.connect(os.path.join(_tmp, 'benchmark.db'))
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE records (id INTEGER PRIMARY KEY, key INTEGER, body TEXT)')
+        started = time.perf_counter()
+        with connection:
+            connection.executemany('INSERT INTO records VALUES (?, ?, ?)', records)
+        insert_rate = rows / (time.perf_counter() - started)
+
+        connection.execute('CREATE INDEX records_key ON records (key)')
+        started = time.perf_counter()
+        for _key in keys:
+            connection.execute('SELECT id, body FROM records WHERE key = ?', (_key,)).fetchall()
+        query_rate = queries / (time.perf_counter() - started)
+
+        fts = None
+        for _module in ('fts5', 'fts4'):
+            try:
+                connection.execute(f'CREATE VIRTUAL TABLE documents USING {_module}(body)')
+            except sqlite3.OperationalError:
+                continue
+            fts = _module
+            break
+        fts_rate = None
+        if fts is not None:
+            with connection:
+                connection.execute('INSERT INTO documents (rowid, body) SELECT id, body FROM records')
+            started = time.perf_counter()
+            for _term in terms:
+                connection.execute('SELECT rowid FROM documents WHERE documents MATCH ? LIMIT 100',
+                                   (_term,)).fetchall()
+            fts_rate = queries / (time.perf_counter() - started)
+        connection.close()
+
+    return {'insert': insert_rate, 'indexed_query': query_rate, 'fts_query': fts_rate, 'fts': fts,
+            'sqlite_version': sqlite3.sqlite_version}
+
+
+def worker(args: argparse.Namespace) -> None:
+    """Run every workload in this interpreter and print the medians of the repeats as JSON."""
+    samples = []
+    for _ in range(args.repeat):
+        samples.append({
+            'tls': measure_tls(args.cert, args.handshakes, args.transfer_mib),
+            'hashlib': measure_hashlib(args.hash_mib),
+            'sqlite': measure_sqlite(args.rows, args.queries),
+        })
+    results = {}
+    for _group, _values in samples[0].items():
+        results[_group] = {}
+        for _key, _value in _values.items():
+            if isinstance(_value, float):
+                results[_group][_key] = statistics.median(_sample[_group][_key] for _sample in samples)
+            else:
+                results[_group][_key] = _value
+    results['openssl_version'] = ssl.OPENSSL_VERSION
+    json.dump(results, sys.stdout)
+
+
+def run(args: argparse.Namespace) -> dict:
+    commands = common.interpreter_commands(args)
+    worker_arguments = ['--worker', '--repeat', str(args.repeat), '--cert', args.cert,
+                        '--handshakes', str(args.handshakes), '--transfer-mib', str(args.transfer_mib),
+                        '--hash-mib', str(args.hash_mib), '--rows', str(args.rows), '--queries', str(args.queries)]
+    measured = {}
+    for _name, _command in commands.items():
+        result = subprocess.run(_command + [os.path.abspath(__file__)] + worker_arguments,
+                                capture_output=True, text=True, check=True)
+        measured[_name] = json.loads(result.stdout)
+
+    def _values(group, key):
+        return {_name: _measured[group][key] for _name, _measured in measured.items()}
+
+    metrics = [
+        common.metric('tls.handshake', 'hs/s', _values('tls', 'handshake'), better='higher'),
+        common.metric('tls.bulk', 'MiB/s', _values('tls', 'bulk'), better='higher'),
+    ]
+    for _name in DIGESTS:
+        metrics.append(common.metric(f'hashlib.{_name}', 'MiB/s', _values('hashlib', _name), better='higher'))
+    for _key, _unit in (('insert', 'rows/s'), ('indexed_query', 'q/s'), ('fts_query', 'q/s')):
+        metrics.append(common.metric(f'sqlite.{_key}', _unit, _values('sqlite', _key), better='higher'))
+    return common.build_results('throughput', commands, metrics,
+                                parameters={'repeat': args.repeat, 'handshakes': args.handshakes,
+                                            'transfer_mib': args.transfer_mib, 'hash_mib': args.hash_mib,
+                                            'rows': args.rows, 'queries': args.queries},
+                                libraries={
+                                    _name: {'openssl': _measured['openssl_version'],
+                                            'tls': f"{_measured['tls']['version']} {_measured['tls']['cipher']}",
+                                            'sqlite': _measured['sqlite']['sqlite_version'],
+                                            'fts': _measured['sqlite']['fts']}
+                                    for _name, _measured in measured.items()
+                                })
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runtime throughput benchmarks of the built AppImage.')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    if '--worker' not in sys.argv:
+        common.add_common_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times every workload is run, the median is reported. (default=%(default)s)')
+    parser.add_argument('--cert', default=str(CERT_FILE),
+                        help='PEM file with the key and certificate of the TLS server. (default=%(default)s)')
+    parser.add_argument('--handshakes', type=int, default=200,
+                        help='Number of TLS connections opened. (default=%(default)s)')
+    parser.add_argument('--transfer-mib', type=int, default=256,
+                        help='MiB sent over one TLS connection. (default=%(default)s)')
+    parser.add_argument('--hash-mib', type=int, default=256,
+                        help='MiB hashed with each digest. (default=%(default)s)')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='Rows inserted into the sqlite database. (default=%(default)s)')
+    parser.add_argument('--queries', type=int, default=20000,
+                        help='Number of indexed and full-text queries. (default=%(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.worker:
+        worker(arguments)
+        sys.exit(0)
+    sys.exit(common.finish(arguments, run(arguments)))
@@ -0,0 +1,18 @@
+import json
+import sys
+from pathlib import Path
+from pytest import fixture, skip
+
+MANIFEST_FILE = Path(sys.base_prefix, 'share', 'python-appimage', 'manifest.json')
+
+
+@fixture(scope='session')
+def build_manifest():
+    with MANIFEST_FILE.open() as f:
+        yield json.load(f)
+
+
+@fixture
+def regrtest(build_manifest):
+    if 'tests' in build_manifest.get('prune', {}).get('categories', []):
+        skip('the test suite was pruned from the image, it runs with --verify before pruning')
@@ -0,0 +1,241 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+from pytest import fixture, raises
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1].joinpath('src')))
+# appimage_venv refuses to load outside an AppImage, stand in with this interpreter.
+os.environ.setdefault('APPIMAGE', sys._base_executable)
+
+import appimage_venv  # noqa: E402
+
+# What AppRun exports, the venv's home is the AppImage rather than a directory.
+PYTHON_ENVIRONMENT = dict(os.environ, PYTHONHOME=sys.base_prefix)
+SITE_PACKAGES = Path('lib', 'python%d.%d' % sys.version_info[:2], 'site-packages')
+
+
+@fixture
+def cache_dir(monkeypatch, tmp_path):
+    directory = tmp_path.joinpath('cache')
+    monkeypatch.setattr(appimage_venv, 'CACHE_DIR', directory)
+    return directory
+
+
+def run_pip(env_dir):
+    return subprocess.run([str(env_dir.joinpath('bin', 'python')), '-m', 'pip', '--version'],
+                          env=PYTHON_ENVIRONMENT, capture_output=True, text=True, check=True).stdout
+
+
+@fixture
+def wheelhouse(monkeypatch, tmp_path):
+    directory = tmp_path.joinpath('wheelhouse')
+    directory.mkdir()
+    monkeypatch.delenv('APPIMAGE_VENV_WHEELHOUSE', raising=False)
+    monkeypatch.setattr(appimage_venv, 'MANIFEST_FILE', tmp_path.joinpath('manifest.json'))
+    return directory
+
+
+def read_pipconf(tmp_path, **kwargs):
+    builder = appimage_venv.AppImageEnvBuilder(**kwargs)
+    context = builder.get_venv_context(str(tmp_path.joinpath('venv')))
+    os.makedirs(context.env_dir)
+    builder.write_pipconf(context)
+    return tmp_path.joinpath('venv', 'pip.conf').read_text().splitlines()
+
+
+def test_wheelhouse_from_manifest(wheelhouse, tmp_path):
+    assert appimage_venv.get_wheelhouse() is None
+    tmp_path.joinpath('manifest.json').write_text(json.dumps({'wheelhouse': {'path': str(wheelhouse)}}))
+    assert appimage_venv.get_wheelhouse() == str(wheelhouse)
+    wheelhouse.rmdir()
+    assert appimage_venv.get_wheelhouse() is None
+
+
+def test_wheelhouse_from_environment(wheelhouse, monkeypatch, tmp_path):
+    tmp_path.joinpath('manifest.json').write_text(json.dumps({'wheelhouse': {'path': str(tmp_path)}}))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('APPIMAGE_VENV_WHEELHOUSE', 'wheelhouse')
+    assert appimage_venv.get_wheelhouse() == str(wheelhouse)
+
+
+def test_pipconf_uses_wheelhouse_and_shared_cache(wheelhouse, cache_dir, tmp_path):
+    lines = read_pipconf(tmp_path, wheelhouse=str(wheelhouse))
+    assert lines == ['[global]', f'target = {tmp_path.joinpath("venv", SITE_PACKAGES)}', 'timeout = 60',
+                     f'cache-dir = {cache_dir.joinpath("pip")}', f'find-links = {wheelhouse}']
+
+
+def test_pipconf_offline_disables_index(wheelhouse, cache_dir, tmp_path):
+    lines = read_pipconf(tmp_path, wheelhouse=str(wheelhouse), offline=True)
+    assert lines[-2:] == [f'find-links = {wheelhouse}', 'no-index = true']
+
+
+def test_pipconf_without_wheelhouse(wheelhouse, cache_dir, tmp_path):
+    lines = read_pipconf(tmp_path)
+    assert not any(_line.startswith(('find-links', 'no-index')) for _line in lines)
+    assert f'cache-dir = {cache_dir.joinpath("pip")}' in lines
+
+
+def test_template_dir_follows_pip_version(cache_dir, monkeypatch):
+    monkeypatch.setattr(appimage_venv.ensurepip, 'version', lambda: '21.2.3')
+    first = appimage_venv.get_template_dir()
+    monkeypatch.setattr(appimage_venv.ensurepip, 'version', lambda: '22.0.4')
+    second = appimage_venv.get_template_dir()
+    assert first != second
+    assert first.parent == second.parent == cache_dir
+    assert first.name == 'python%d.%d.%d-pip21.2.3' % sys.version_info[:3]
+
+
+def test_second_venv_clones_template(cache_dir, monkeypatch, tmp_path):
+    created = []
+    create_template = appimage_venv.AppImageEnvBuilder._create_template
+
+    def _create_template(self, template):
+        created.append(template)
+        create_template(self, template)
+
+    monkeypatch.setattr(appimage_venv.AppImageEnvBuilder, '_create_template', _create_template)
+    for _name in ('first', 'second'):
+        appimage_venv.create(str(tmp_path.joinpath(_name)), symlinks=True, with_pip=True)
+
+    template = appimage_venv.get_template_dir()
+    assert created == [template]
+    pip = SITE_PACKAGES.joinpath('pip', '__init__.py')
+    assert tmp_path.joinpath('second', pip).stat().st_ino == template.joinpath('venv', pip).stat().st_ino
+    shebang = tmp_path.joinpath('second', 'bin', 'pip').read_text().splitlines()[0]
+    assert shebang == '#!%s' % tmp_path.joinpath('second', 'bin', 'python')
+    assert 'from %s' % tmp_path.joinpath('second', SITE_PACKAGES, 'pip') in run_pip(tmp_path.joinpath('second'))
+
+
+def test_create_all_builds_independent_venvs(cache_dir, tmp_path):
+    builders = []
+
+    def _make_builder():
+        builders.append(appimage_venv.AppImageEnvBuilder(symlinks=True, with_pip=False, system_site_packages=True))
+        return builders[-1]
+
+    dirs = [str(tmp_path.joinpath(f'venv-{_index}')) for _index in range(6)]
+    assert appimage_venv.create_all(_make_builder, dirs, jobs=3) == {}
+    assert len({id(_builder) for _builder in builders}) == len(dirs)
+    for _dir in map(Path, dirs):
+        pyvenv_cfg = _dir.joinpath('pyvenv.cfg').read_text()
+        assert 'include-system-site-packages = true' in pyvenv_cfg
+        assert 'home = %s' % os.environ['APPIMAGE'] in pyvenv_cfg
+        pip_conf = _dir.joinpath('pip.conf').read_text()
+        assert 'target = %s\n' % _dir.joinpath(SITE_PACKAGES) in pip_conf
+        for _other in set(dirs) - {str(_dir)}:
+            assert _other + os.sep not in pip_conf
+        assert 'VIRTUAL_ENV="%s"' % _dir in _dir.joinpath('bin', 'activate').read_text()
+
+
+def test_create_all_reports_failures(cache_dir, tmp_path):
+    blocked = tmp_path.joinpath('blocked')
+    blocked.write_text('')
+    dirs = [str(blocked), str(tmp_path.joinpath('venv'))]
+    failures = appimage_venv.create_all(lambda: appimage_venv.AppImageEnvBuilder(with_pip=False), dirs, jobs=2)
+    assert list(failures) == [str(blocked)]
+    assert tmp_path.joinpath('venv', 'pip.conf').is_file()
+
+
+@fixture
+def venv(tmp_path):
+    env_dir = tmp_path.joinpath('a', 'venv')
+    env_dir.joinpath('bin').mkdir(parents=True)
+    env_dir.joinpath(SITE_PACKAGES).mkdir(parents=True)
+    env_dir.joinpath('pyvenv.cfg').write_text('home = /opt/python.AppImage\n')
+    script = env_dir.joinpath('bin', 'tool')
+    script.write_text(f'#!{env_dir}/bin/python\nimport tool\n')
+    script.chmod(0o755)
+    env_dir.joinpath(SITE_PACKAGES, 'extra.pth').write_text(
+        f'{env_dir}/src\n{env_dir}2/src\n/b{env_dir}/src\n{env_dir}-old/src\n')
+    env_dir.joinpath(SITE_PACKAGES, 'module.pyc').write_bytes(b'\0\0\r\n' + os.fsencode(env_dir) + b'/module.py')
+    env_dir.joinpath('bin', 'python').symlink_to(os.environ['APPIMAGE'])
+    env_dir.joinpath('bin', 'python3').symlink_to(env_dir.joinpath('bin', 'python'))
+    return env_dir
+
+
+def test_relocate_rewrites_text_files(venv, tmp_path):
+    destination = tmp_path.joinpath('b', 'venv')
+    assert appimage_venv.relocate(str(venv), str(destination)) == (2, 1)
+    assert destination.joinpath('bin', 'tool').read_text() == f'#!{destination}/bin/python\nimport tool\n'
+    assert os.access(destination.joinpath('bin', 'tool'), os.X_OK)
+    assert os.readlink(destination.joinpath('bin', 'python3')) == str(destination.joinpath('bin', 'python'))
+    assert os.readlink(destination.joinpath('bin', 'python')) == os.environ['APPIMAGE']
+    # The source is untouched, although its files were hardlinked.
+    assert venv.joinpath('bin', 'tool').read_text() == f'#!{venv}/bin/python\nimport tool\n'
+
+
+def test_relocate_only_rewrites_whole_prefix(venv, tmp_path):
+    destination = tmp_path.joinpath('b', 'venv')
+    appimage_venv.relocate(str(venv), str(destination))
+    assert destination.joinpath(SITE_PACKAGES, 'extra.pth').read_text().splitlines() == [
+        f'{destination}/src', f'{venv}2/src', f'/b{venv}/src', f'{venv}-old/src',
+    ]
+
+
+def test_relocate_leaves_binary_files(venv, tmp_path):
+    destination = tmp_path.joinpath('b', 'venv')
+    appimage_venv.relocate(str(venv), str(destination))
+    pyc = SITE_PACKAGES.joinpath('module.pyc')
+    assert destination.joinpath(pyc).read_bytes() == venv.joinpath(pyc).read_bytes()
+
+
+def test_relocate_keeps_backslashes_literal(venv, tmp_path):
+    destination = tmp_path.joinpath(r'b\1', r'venv\g<0>')
+    assert appimage_venv.relocate(str(venv), str(destination)) == (2, 1)
+    assert destination.joinpath('bin', 'tool').read_text() == f'#!{destination}/bin/python\nimport tool\n'
+    assert os.readlink(destination.joinpath('bin', 'python3')) == str(destination.joinpath('bin', 'python'))
+
+
+def test_relocate_moves(venv, tmp_path):
+    destination = tmp_path.joinpath('b', 'venv')
+    appimage_venv.relocate(str(venv), str(destination), move=True)
+    assert not venv.exists()
+    assert destination.joinpath('bin', 'tool').read_text().startswith(f'#!{destination}/bin/python\n')
+
+
+def test_relocate_rejects_existing_destination(venv, tmp_path):
+    with raises(ValueError, match='already exists'):
+        appimage_venv.relocate(str(venv), str(tmp_path))
+    with raises(ValueError, match='not a virtual environment'):
+        appimage_venv.relocate(str(tmp_path), str(tmp_path.joinpath('c')))
+
+
+def test_rewrite_file_writes_new_file(tmp_path):
+    original = tmp_path.joinpath('original')
+    original.write_text('/a/venv/bin\n')
+    link = tmp_path.joinpath('link')
+    os.link(original, link)
+    pattern = re.compile(rb'(?<![\w.-])/a/venv(?![\w.-])')
+    assert appimage_venv._rewrite_file(str(link), pattern, b'/b/venv')
+    assert link.read_text() == '/b/venv/bin\n'
+    assert original.read_text() == '/a/venv/bin\n'
+    assert not appimage_venv._rewrite_file(str(link), pattern, b'/b/venv')
+    tmp_path.joinpath('empty').write_bytes(b'')
+    assert not appimage_venv._rewrite_file(str(tmp_path.joinpath('empty')), pattern, b'/b/venv')
+
+
+def test_clone_file_hardlinks(tmp_path):
+    source = tmp_path.joinpath('source')
+    source.write_text('content')
+    appimage_venv.clone_file(source, tmp_path.joinpath('clone'))
+    assert tmp_path.joinpath('clone').stat().st_ino == source.stat().st_ino
+
+
+def test_clone_file_copies_without_links(monkeypatch, tmp_path):
+    def _fail(*args):
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(appimage_venv.os, 'link', _fail)
+    monkeypatch.setattr(appimage_venv.fcntl, 'ioctl', _fail)
+    source = tmp_path.joinpath('source')
+    source.write_text('content')
+    source.chmod(0o750)
+    clone = tmp_path.joinpath('clone')
+    appimage_venv.clone_file(source, clone)
+    assert clone.read_text() == 'content'
+    assert clone.stat().st_ino != source.stat().st_ino
+    assert clone.stat().st_mode == source.stat().st_mode
@@ -0,0 +1,67 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from pytest import fixture, mark
+
+LAUNCH_RUNS = 20
+# Launch time allowed on top of the bare interpreter, as a fraction of its start time. The AppImage runtime mounts
+# the image before AppRun starts, which costs a multiple of the interpreter's own start.
+LAUNCH_MARGINS = {'AppRun': 1.0, 'APPIMAGE': 10.0}
+# An absolute limit only applies when set explicitly, since it depends on the machine.
+LAUNCH_LIMIT_MS = float(os.environ['APPRUN_LAUNCH_LIMIT_MS']) if 'APPRUN_LAUNCH_LIMIT_MS' in os.environ else None
+
+
+@fixture(scope='session')
+def app_dir():
+    if 'APPDIR' not in os.environ:
+        raise RuntimeError('These tests must be run by the AppImage python.')
+    return Path(os.environ['APPDIR'])
+
+
+def median_launch_ms(command, env=None):
+    samples = []
+    for _ in range(LAUNCH_RUNS):
+        started = time.perf_counter()
+        subprocess.run(command + ['-c', 'pass'], env=env, check=True)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def test_apprun_exports_valid_paths(app_dir):
+    assert Path(os.environ['PYTHONHOME']).is_dir()
+    for entry in os.environ['LD_LIBRARY_PATH'].split(':'):
+        if entry.startswith(str(app_dir)):
+            assert Path(entry).is_dir(), entry
+    for entry in filter(None, os.environ.get('PYTHONPATH', '').split(':')):
+        assert Path(entry).exists(), entry
+    assert os.environ['PATH'].split(':')[0] == str(app_dir.joinpath('usr', 'local', 'bin'))
+
+
+def test_apprun_ignores_foreign_appdir(app_dir, tmp_path):
+    environment = dict(os.environ, APPDIR=str(tmp_path))
+    result = subprocess.run([str(app_dir.joinpath('AppRun')), '-c', 'import sys; print(sys.prefix)'],
+                            env=environment, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == str(app_dir.joinpath('usr', 'local'))
+
+
+def test_apprun_has_resolved_interpreter(app_dir):
+    app_run = app_dir.joinpath('AppRun').read_text()
+    assert '__PYTHON_EXECUTABLE__' not in app_run
+    assert '.desktop' not in app_run
+
+
+@mark.parametrize('launcher', ['AppRun', 'APPIMAGE'])
+def test_launch_latency(app_dir, launcher):
+    if launcher == 'AppRun':
+        command = [str(app_dir.joinpath('AppRun'))]
+    else:
+        command = [os.environ['APPIMAGE']]
+    # The interpreter started directly, with the environment AppRun exported, is the baseline of the same run.
+    baseline = median_launch_ms([sys.executable], env=os.environ)
+    latency = median_launch_ms(command)
+    assert latency < baseline * (1 + LAUNCH_MARGINS[launcher]), f'{latency:.1f}ms, baseline {baseline:.1f}ms'
+    if LAUNCH_LIMIT_MS is not None:
+        assert latency < LAUNCH_LIMIT_MS
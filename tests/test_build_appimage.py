@@ -0,0 +1,512 @@
+import importlib.util
+import json
+import os
+import py_compile
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from pytest import fixture, raises
+
+BUILD_SCRIPT = Path(__file__).absolute().parents[1].joinpath('build-appimage.py')
+_spec = importlib.util.spec_from_file_location('build_appimage', BUILD_SCRIPT)
+build_appimage = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(build_appimage)
+
+
+@fixture
+def app_dir(tmp_path):
+    directory = tmp_path.joinpath('AppDir')
+    directory.joinpath('usr', 'local', 'lib').mkdir(parents=True)
+    directory.joinpath('usr', 'local', 'lib', 'libexample.so').write_bytes(b'library')
+    return directory
+
+
+@fixture
+def cache(tmp_path):
+    return build_appimage.ArtifactCache(tmp_path.joinpath('cache'), 1024 * 1024)
+
+
+def test_cache_round_trip(cache, app_dir, tmp_path):
+    cache.store('key', app_dir, ['usr/local/lib', 'usr/local/missing'], {'version': '3.10.0'})
+    restored = tmp_path.joinpath('restored')
+    assert cache.restore('key', restored) == {'version': '3.10.0'}
+    assert restored.joinpath('usr', 'local', 'lib', 'libexample.so').read_bytes() == b'library'
+
+
+def test_cache_miss(cache, tmp_path):
+    assert cache.restore('missing', tmp_path.joinpath('restored')) is None
+
+
+def test_cache_rejects_corrupt_sidecar(cache, app_dir, tmp_path):
+    cache.store('key', app_dir, ['usr/local/lib'], {'version': '3.10.0'})
+    cache.directory.joinpath('key.json').write_text('{"version": ')
+    restored = tmp_path.joinpath('restored')
+    assert cache.restore('key', restored) is None
+    assert not restored.joinpath('usr').exists()
+
+
+def test_cache_excludes_paths(cache, app_dir, tmp_path):
+    manifest = app_dir.joinpath(build_appimage.MANIFEST_PATH)
+    manifest.parent.mkdir(parents=True)
+    manifest.write_text(json.dumps({'python': {'profile': 'debug'}}))
+    exclude = [build_appimage.MANIFEST_PATH.parent.as_posix()]
+    cache.store('key', app_dir, ['usr/local/lib', 'usr/local/share'], {}, exclude)
+
+    restored = tmp_path.joinpath('restored')
+    restored.joinpath(build_appimage.MANIFEST_PATH).parent.mkdir(parents=True)
+    restored.joinpath(build_appimage.MANIFEST_PATH).write_text('{}')
+    assert cache.restore('key', restored, exclude) == {}
+    assert restored.joinpath(build_appimage.MANIFEST_PATH).read_text() == '{}'
+    assert restored.joinpath('usr', 'local', 'lib', 'libexample.so').exists()
+
+
+def test_cache_evicts_least_recently_used(app_dir, tmp_path):
+    library = app_dir.joinpath('usr', 'local', 'lib', 'libexample.so')
+    library.write_bytes(os.urandom(64 * 1024))
+    cache = build_appimage.ArtifactCache(tmp_path.joinpath('cache'), 240 * 1024)
+    for _index, _key in enumerate(('first', 'second', 'third')):
+        cache.store(_key, app_dir, ['usr/local/lib'], {})
+        past = time.time() - 100 + _index
+        os.utime(cache.directory.joinpath(f'{_key}.tar'), (past, past))
+    cache.restore('first', tmp_path.joinpath('restored'))
+
+    cache.store('fourth', app_dir, ['usr/local/lib'], {})
+    remaining = sorted(_archive.stem for _archive in cache.directory.glob('*.tar'))
+    assert remaining == ['first', 'fourth', 'third']
+    assert not cache.directory.joinpath('second.json').exists()
+
+
+def test_run_stages_passes_dependency_results():
+    stages = [
+        build_appimage.Stage('sqlite', lambda _: 'sqlite-key'),
+        build_appimage.Stage('openssl', lambda _: 'openssl-key'),
+        build_appimage.Stage('cpython', lambda deps: sorted(deps.values()), ('sqlite', 'openssl')),
+    ]
+    results = build_appimage.run_stages(stages)
+    assert results['cpython'] == ['openssl-key', 'sqlite-key']
+
+
+def test_run_stages_rejects_unknown_and_cyclic_dependencies():
+    with raises(build_appimage.AppImageError, match='unknown'):
+        build_appimage.run_stages([build_appimage.Stage('cpython', lambda _: None, ('sqlite',))])
+    with raises(build_appimage.AppImageError, match='cyclic'):
+        build_appimage.run_stages([build_appimage.Stage('a', lambda _: None, ('b',)),
+                                   build_appimage.Stage('b', lambda _: None, ('a',))])
+
+
+def test_run_stages_reraises_first_failure():
+    def _fail(_):
+        raise build_appimage.AppImageError('configure failed')
+
+    started = []
+    stages = [
+        build_appimage.Stage('sqlite', _fail),
+        build_appimage.Stage('cpython', lambda _: started.append('cpython'), ('sqlite',)),
+    ]
+    with raises(build_appimage.AppImageError, match='configure failed'):
+        build_appimage.run_stages(stages)
+    assert not started
+
+
+def test_critical_path():
+    stages = [
+        build_appimage.Stage('sqlite', lambda _: None, started=0.0, finished=2.0),
+        build_appimage.Stage('openssl', lambda _: None, started=0.0, finished=5.0),
+        build_appimage.Stage('cpython', lambda _: None, ('sqlite', 'openssl'), started=5.0, finished=15.0),
+        build_appimage.Stage('appimage', lambda _: None, ('cpython',), started=15.0, finished=16.0),
+    ]
+    assert build_appimage.get_critical_path(stages) == (['openssl', 'cpython', 'appimage'], 16.0)
+
+
+def test_interpreter_stages_prune_before_zip_and_verify_first(monkeypatch, tmp_path):
+    monkeypatch.setattr('sys.argv', ['build-appimage.py', 'sources', 'resources', '--zip-stdlib', '--verify'])
+    args = build_appimage.get_args()
+    config = {'source_path': tmp_path.joinpath('cpython-3.10.0.tar.gz'), 'version': '3.10.0'}
+    stages = build_appimage.get_interpreter_stages(args, config, tmp_path, tmp_path, None, None)
+    assert [_stage.name for _stage in stages] == [
+        'cpython-3.10.0', 'appimage_venv-3.10.0', 'bytecode-3.10.0', 'verify-3.10.0', 'prune-3.10.0',
+        'stdlib_zip-3.10.0', 'appimage-3.10.0',
+    ]
+    for _previous, _stage in zip(stages[2:], stages[3:]):
+        assert _previous.name in _stage.dependencies
+
+
+@fixture
+def tarballs(tmp_path):
+    sources = tmp_path.joinpath('sources')
+    sources.mkdir()
+    paths = []
+    for _name in ('sqlite-3.36.0', 'cpython-3.10.0'):
+        tree = tmp_path.joinpath('trees', _name)
+        tree.mkdir(parents=True)
+        tree.joinpath('configure').write_text('#!/bin/sh\n')
+        path = sources.joinpath(f'{_name}.tar.gz')
+        with tarfile.open(path, mode='w:gz') as _tar:
+            _tar.add(tree, arcname=_name)
+        paths.append(path)
+    return paths
+
+
+def test_build_tree_unpacks_speculative_sources_on_first_extraction(tarballs, tmp_path):
+    sqlite, cpython = tarballs
+    tree = build_appimage.BuildTree(tmp_path.joinpath('src'))
+    tree.speculate(cpython)
+    directory = tree.extract(sqlite).result()
+    assert directory.joinpath('sqlite-3.36.0', 'configure').is_file()
+    assert tree.extract(cpython).result().joinpath('cpython-3.10.0', 'configure').is_file()
+    tree.shutdown()
+
+
+def test_build_tree_unpacks_nothing_without_extraction(tarballs, tmp_path):
+    tree = build_appimage.BuildTree(tmp_path.joinpath('src'))
+    for _tarball in tarballs:
+        tree.speculate(_tarball)
+    tree.shutdown()
+    assert not tmp_path.joinpath('src').exists()
+
+
+def test_jobserver_tokens_take_free_tokens_and_return_them(monkeypatch):
+    monkeypatch.setattr(build_appimage, '_jobserver', None)
+    monkeypatch.setattr(build_appimage, '_jobserver_reader', None)
+    monkeypatch.setattr(build_appimage, '_jobserver_jobs', 1)
+    build_appimage.configure_jobserver(4)
+    read_fd, write_fd = build_appimage._jobserver
+    try:
+        # make reads the pipe with blocking reads, only the reader of jobserver_tokens is non-blocking.
+        assert os.get_blocking(read_fd)
+        assert not os.get_blocking(build_appimage._jobserver_reader)
+        assert os.read(read_fd, 1) == b'+'
+        with build_appimage.jobserver_tokens() as jobs:
+            assert jobs == 3
+            with build_appimage.jobserver_tokens() as nested:
+                assert nested == 1
+        os.write(write_fd, b'+')
+        with build_appimage.jobserver_tokens() as jobs:
+            assert jobs == 4
+    finally:
+        os.close(build_appimage._jobserver_reader)
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def write_elf(path, needed=(), rpath=()):
+    """Write a minimal x86_64 shared object with DT_NEEDED and DT_RPATH entries."""
+    strings = b'\0'
+    entries = []
+    for _tag, _value in [(1, _name) for _name in needed] + ([(15, ':'.join(rpath))] if rpath else []):
+        entries.append((_tag, len(strings)))
+        strings += _value.encode() + b'\0'
+    dynamic_offset = 64 + 2 * 56
+    strtab_offset = dynamic_offset + (len(entries) + 2) * 16
+    entries += [(5, strtab_offset), (0, 0)]  # DT_STRTAB, DT_NULL
+    size = strtab_offset + len(strings)
+    header = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+    header += struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, 64, 0, 0, 64, 56, 2, 0, 0, 0)
+    header += struct.pack('<IIQQQQQQ', 1, 4, 0, 0, 0, size, size, 4096)  # PT_LOAD
+    header += struct.pack('<IIQQQQQQ', 2, 4, dynamic_offset, dynamic_offset, dynamic_offset,
+                          len(entries) * 16, len(entries) * 16, 8)  # PT_DYNAMIC
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(header + b''.join(struct.pack('<qQ', *_entry) for _entry in entries) + strings)
+
+
+def test_library_closure_uses_appdir_copies_of_deps(monkeypatch, tmp_path):
+    app_dir, deps_dir, host_dir = tmp_path.joinpath('AppDir'), tmp_path.joinpath('deps'), tmp_path.joinpath('host')
+    for _dir in (app_dir, deps_dir):
+        write_elf(_dir.joinpath('usr', 'local', 'sqlite3', 'lib', 'libsqlite3.so.0'), needed=['libc.so.6'])
+    write_elf(host_dir.joinpath('libexample.so.1'), needed=['libc.so.6'])
+    write_elf(app_dir.joinpath('usr', 'local', 'bin', 'python3.10'),
+              needed=['libsqlite3.so.0', 'libexample.so.1', 'libc.so.6'],
+              rpath=[f'{deps_dir}/usr/local/sqlite3/lib', f'{deps_dir}/usr/local/ssl/lib'])
+    monkeypatch.setenv('LD_LIBRARY_PATH', str(host_dir))
+
+    python = app_dir.joinpath('usr', 'local', 'bin', 'python3.10')
+    libraries = build_appimage.get_library_closure(app_dir, [(str(deps_dir), str(app_dir))])
+    assert libraries == {host_dir.joinpath('libexample.so.1'): [python]}
+    # Without the alias the RPATH into the dependency directory wins.
+    libraries = build_appimage.get_library_closure(app_dir)
+    assert deps_dir.joinpath('usr', 'local', 'sqlite3', 'lib', 'libsqlite3.so.0') in libraries
+
+
+def test_library_closure_reports_missing_libraries(tmp_path):
+    app_dir = tmp_path.joinpath('AppDir')
+    write_elf(app_dir.joinpath('usr', 'local', 'bin', 'python3.10'), needed=['libmissing.so.1'])
+    with raises(build_appimage.AppImageError, match='libmissing.so.1'):
+        build_appimage.get_library_closure(app_dir)
+
+
+@fixture
+def command_logs(monkeypatch, tmp_path):
+    monkeypatch.setattr(build_appimage, '_command_log_dir', None)
+    monkeypatch.setattr(build_appimage, '_command_log_tail', build_appimage.DEFAULT_LOG_TAIL)
+    directory = tmp_path.joinpath('logs')
+    build_appimage.configure_command_logs(directory, tail=3)
+    return directory.joinpath(f'{threading.current_thread().name}.log')
+
+
+def test_run_command_streams_output_to_stage_log(command_logs):
+    output = build_appimage.run_command('echo one && echo two >&2')
+    assert output.splitlines() == ['one', 'two']
+    assert command_logs.read_text().splitlines()[1:] == ['one', 'two']
+    assert command_logs.read_text().startswith('$ echo one')
+
+
+def test_run_command_keeps_tail_of_failure(command_logs):
+    with raises(build_appimage.AppImageError) as error:
+        build_appimage.run_command('for i in 1 2 3 4 5 6; do echo line$i; done; exit 3')
+    message = str(error.value)
+    assert 'exit code 3' in message
+    assert message.splitlines()[-3:] == ['line4', 'line5', 'line6']
+    assert 'line3' not in message
+    assert 'line1' in command_logs.read_text()
+
+
+def test_run_command_captures_output(command_logs):
+    assert build_appimage.run_command('echo captured', capture=True) == 'captured\n'
+    assert not command_logs.exists()
+    with raises(build_appimage.AppImageError, match='broken'):
+        build_appimage.run_command('echo broken >&2; false', capture=True)
+
+
+VERSION = '%d.%d.0' % sys.version_info[:2]
+
+
+def compile_sources(lib_dir, mode, levels=(0, 1, 2)):
+    for source in lib_dir.rglob('*.py'):
+        for level in levels:
+            py_compile.compile(str(source), cfile=importlib.util.cache_from_source(source, optimization=level or ''),
+                               optimize=level, invalidation_mode=mode, doraise=True)
+
+
+@fixture
+def lib_dir(tmp_path):
+    directory = tmp_path.joinpath('lib')
+    directory.joinpath('package').mkdir(parents=True)
+    directory.joinpath('module.py').write_text('"""Module."""\nassert True\n')
+    directory.joinpath('package', '__init__.py').write_text('')
+    directory.joinpath('badsyntax_example.py').write_text('def\n')
+    return directory
+
+
+def test_verify_bytecode_accepts_complete_bytecode(lib_dir):
+    lib_dir.joinpath('badsyntax_example.py').unlink()
+    compile_sources(lib_dir, py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    build_appimage.verify_bytecode(lib_dir, VERSION, 'unchecked-hash')
+
+
+def test_verify_bytecode_flags_missing_optimization_levels(lib_dir):
+    lib_dir.joinpath('badsyntax_example.py').unlink()
+    compile_sources(lib_dir, py_compile.PycInvalidationMode.UNCHECKED_HASH, levels=(0,))
+    with raises(build_appimage.AppImageError, match='4 pyc files') as error:
+        build_appimage.verify_bytecode(lib_dir, VERSION, 'unchecked-hash')
+    assert '.opt-1.pyc is missing' in str(error.value)
+    assert '.opt-2.pyc is missing' in str(error.value)
+
+
+def test_verify_bytecode_flags_wrong_invalidation_mode(lib_dir):
+    lib_dir.joinpath('badsyntax_example.py').unlink()
+    compile_sources(lib_dir, py_compile.PycInvalidationMode.CHECKED_HASH)
+    with raises(build_appimage.AppImageError, match='6 pyc files') as error:
+        build_appimage.verify_bytecode(lib_dir, VERSION, 'unchecked-hash')
+    assert 'is not unchecked-hash' in str(error.value)
+    build_appimage.verify_bytecode(lib_dir, VERSION, 'checked-hash')
+
+
+def test_verify_bytecode_skips_excluded_sources(lib_dir):
+    compile_sources(lib_dir.joinpath('package'), py_compile.PycInvalidationMode.TIMESTAMP)
+    lib_dir.joinpath('module.py').unlink()
+    build_appimage.verify_bytecode(lib_dir, VERSION, 'timestamp')
+
+
+def test_zip_stdlib_zips_only_pure_python(app_dir, monkeypatch):
+    lib_dir = build_appimage.get_python_lib_dir(app_dir, VERSION)
+    for name, content in {'module.py': 'VALUE = 1\n', 'os.py': '', 'pure/__init__.py': 'from .sub import VALUE\n',
+                          'pure/sub.py': 'VALUE = 2\n', 'data/__init__.py': '', 'data/table.txt': 'data\n',
+                          'test/test_module.py': '', 'config-x86_64/Makefile': ''}.items():
+        lib_dir.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        lib_dir.joinpath(name).write_text(content)
+    compile_sources(lib_dir, py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    commands = []
+    monkeypatch.setattr(build_appimage, 'measure_startup', lambda *_: {'from_disk': 1, 'from_zip': 0, 'startup_ms': 1})
+    monkeypatch.setattr(build_appimage, 'run_command', commands.append)
+
+    measurements = build_appimage.zip_stdlib(app_dir, VERSION)
+
+    zip_file = lib_dir.parent.joinpath('python%d%d.zip' % sys.version_info[:2])
+    with zipfile.ZipFile(zip_file) as archive:
+        assert sorted(archive.namelist()) == ['module.py', 'module.pyc', 'pure/__init__.py', 'pure/__init__.pyc',
+                                              'pure/sub.py', 'pure/sub.pyc']
+    assert measurements['modules'] == 3
+    assert not lib_dir.joinpath('module.py').exists()
+    assert not lib_dir.joinpath('pure').exists()
+    assert not list(lib_dir.glob('__pycache__/module.*.pyc'))
+    for kept in ('os.py', 'data/__init__.py', 'data/table.txt', 'test/test_module.py', 'config-x86_64/Makefile'):
+        assert lib_dir.joinpath(kept).is_file()
+    assert 'import ssl, sqlite3, curses, appimage_venv' in commands[0]
+
+    result = subprocess.run([sys.executable, '-c', 'import module, pure; print(module.__file__, pure.VALUE)'],
+                            env=dict(os.environ, PYTHONPATH=str(zip_file)), capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.split() == [str(zip_file.joinpath('module.pyc')), '2']
+
+
+def write_files(directory, files):
+    for name, content in files.items():
+        directory.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        directory.joinpath(name).write_bytes(content)
+
+
+def test_remove_unkept_keeps_matching_files_of_removed_directory(app_dir):
+    config_dir = 'usr/local/lib/python3.10/config-3.10-x86_64-linux-gnu'
+    write_files(app_dir, {f'{config_dir}/Makefile': b'all:', f'{config_dir}/libpython3.10.a': b'archive',
+                          f'{config_dir}/nested/python.o': b'object'})
+    removed = build_appimage.remove_unkept(app_dir, app_dir.joinpath(config_dir),
+                                           ['usr/local/lib/python*/config-*/Makefile'])
+    assert removed == len(b'archive') + len(b'object')
+    assert sorted(_path.name for _path in app_dir.joinpath(config_dir).rglob('*')) == ['Makefile']
+
+
+def test_remove_unkept_keeps_whole_subtree(app_dir):
+    write_files(app_dir, {'usr/local/include/python3.10/Python.h': b'header',
+                          'usr/local/include/python3.10/cpython/object.h': b'header',
+                          'usr/local/include/sqlite3.h': b'header'})
+    keep = ['usr/local/include/python*']
+    assert build_appimage.remove_unkept(app_dir, app_dir.joinpath('usr', 'local', 'include'), keep) == len(b'header')
+    assert app_dir.joinpath('usr/local/include/python3.10/cpython/object.h').is_file()
+    assert not app_dir.joinpath('usr/local/include/sqlite3.h').exists()
+
+
+def test_deduplicate_files_links_only_identical_files(app_dir):
+    write_files(app_dir, {'a/one': b'identical', 'b/two': b'identical', 'c/three': b'different', 'd/empty': b'',
+                          'e/empty': b''})
+    app_dir.joinpath('c', 'four').write_bytes(b'identical')
+    app_dir.joinpath('c', 'four').chmod(0o755)
+    assert build_appimage.deduplicate_files(app_dir) == len(b'identical')
+    assert app_dir.joinpath('a/one').stat().st_ino == app_dir.joinpath('b/two').stat().st_ino
+    assert app_dir.joinpath('b/two').read_bytes() == b'identical'
+    for name in ('c/three', 'c/four', 'd/empty', 'usr/local/lib/libexample.so'):
+        assert app_dir.joinpath(name).stat().st_nlink == 1
+    assert not list(app_dir.rglob('.*.dedupe'))
+
+
+def test_prune_app_dir_records_removed_categories(app_dir, tmp_path):
+    write_files(app_dir, {'usr/local/lib/python3.10/test/test_os.py': b'tests',
+                          'usr/local/lib/python3.10/idlelib/idle.py': b'idle',
+                          'usr/local/lib/python3.10/ensurepip/_bundled/pip.whl': b'pip'})
+    manifest_file = tmp_path.joinpath('prune.json')
+    manifest_file.write_text(json.dumps({'categories': {
+        'tests': {'remove': ['usr/local/lib/python*/test']},
+        'idle': {'enabled': True, 'remove': ['usr/local/lib/python*/idlelib', 'usr/local/bin/idle*']},
+        'ensurepip': {'enabled': False, 'remove': ['usr/local/lib/python*/ensurepip/_bundled']},
+    }}))
+    with build_appimage.TIMELINE.span('prune'):
+        saved = build_appimage.prune_app_dir(app_dir, manifest_file)
+    assert saved == {'tests': len(b'tests'), 'idle': len(b'idle')}
+    assert not app_dir.joinpath('usr/local/lib/python3.10/test').exists()
+    assert app_dir.joinpath('usr/local/lib/python3.10/ensurepip/_bundled/pip.whl').is_file()
+    manifest = json.loads(app_dir.joinpath(build_appimage.MANIFEST_PATH).read_text())
+    assert manifest['prune'] == {'categories': ['tests', 'idle']}
+
+
+@fixture
+def configure_commands(monkeypatch):
+    commands = []
+    monkeypatch.setattr(build_appimage, 'run_command', lambda command, **_: commands.append(command))
+    return commands
+
+
+def test_run_configure_reuses_persistent_tree(configure_commands, tmp_path):
+    tree = build_appimage.BuildTree(tmp_path, persistent=True, exports='CC="ccache gcc" ')
+    build_appimage.run_configure('./configure --prefix=/usr/local', tmp_path, tree)
+    build_appimage.run_configure('./configure --prefix=/usr/local', tmp_path, tree)
+    assert configure_commands == ['CC="ccache gcc" ./configure --prefix=/usr/local']
+    build_appimage.run_configure('./configure --prefix=/opt', tmp_path, tree)
+    tree.exports = ''
+    build_appimage.run_configure('./configure --prefix=/opt', tmp_path, tree)
+    assert configure_commands[1:] == ['CC="ccache gcc" ./configure --prefix=/opt', './configure --prefix=/opt']
+
+
+def test_run_configure_always_runs_in_throwaway_tree(configure_commands, tmp_path):
+    tree = build_appimage.BuildTree(tmp_path)
+    build_appimage.run_configure('./configure', tmp_path, tree)
+    build_appimage.run_configure('./configure', tmp_path, tree)
+    assert configure_commands == ['./configure', './configure']
+
+
+def test_run_configure_drops_stamp_of_failed_run(tmp_path):
+    tree = build_appimage.BuildTree(tmp_path, persistent=True)
+    build_appimage.run_configure('true', tmp_path, tree)
+    assert tmp_path.joinpath('.appimage-configure').exists()
+    with raises(build_appimage.AppImageError):
+        build_appimage.run_configure('false', tmp_path, tree)
+    assert not tmp_path.joinpath('.appimage-configure').exists()
+
+
+def test_make_readable_sets_missing_permissions(tmp_path):
+    write_files(tmp_path, {'private/secret': b'', 'private/nested/data': b'', 'public': b''})
+    tmp_path.joinpath('private', 'nested').chmod(0o700)
+    tmp_path.joinpath('private', 'nested', 'data').chmod(0o600)
+    tmp_path.joinpath('private', 'secret').chmod(0o750)
+    tmp_path.joinpath('private').chmod(0o711)
+    tmp_path.joinpath('public').chmod(0o644)
+    tmp_path.joinpath('link').symlink_to('private/secret')
+    assert build_appimage.make_readable(tmp_path) == 4
+    modes = {_path.relative_to(tmp_path).as_posix(): _path.lstat().st_mode & 0o777 for _path in tmp_path.rglob('*')}
+    assert modes == {'private': 0o715, 'private/nested': 0o705, 'private/nested/data': 0o604,
+                     'private/secret': 0o754, 'public': 0o644, 'link': 0o777}
+    assert build_appimage.make_readable(tmp_path) == 0
+
+
+def test_openssl_speed_compared_with_previous_build(cache, monkeypatch):
+    figures = iter([{'sha256': 1000.0}, {'sha256': 900.0}])
+    monkeypatch.setattr(build_appimage, 'measure_openssl_speed', lambda _: next(figures))
+    build = {'key': 'first', 'version': '3.0.0', 'options': ['no-shared']}
+    with build_appimage.TIMELINE.span('openssl'):
+        first = build_appimage.compare_openssl_speed('openssl', cache, build)
+    assert first == {'built': {'sha256': 1000.0}, 'previous': None}
+    with build_appimage.TIMELINE.span('openssl'):
+        second = build_appimage.compare_openssl_speed('openssl', cache, dict(build, key='second'))
+    assert second == {'built': {'sha256': 900.0}, 'previous': dict(build, speed={'sha256': 1000.0})}
+    assert cache.load_measurements('openssl-speed')['key'] == 'second'
+    cache.evict()
+    assert cache.load_measurements('openssl-speed') is not None
+
+
+def test_openssl_speed_without_cache(monkeypatch):
+    monkeypatch.setattr(build_appimage, 'measure_openssl_speed', lambda _: {'sha256': 1000.0})
+    with build_appimage.TIMELINE.span('openssl'):
+        assert build_appimage.compare_openssl_speed('openssl', None, {})['previous'] is None
+
+
+def test_configure_sqlite_passes_profile_options(tarballs, tmp_path, monkeypatch):
+    configured = []
+    monkeypatch.setattr(build_appimage, 'get_toolchain_identity', lambda: 'toolchain')
+    monkeypatch.setattr(build_appimage, 'run_configure', lambda command, *_: configured.append(command))
+    monkeypatch.setattr(build_appimage, 'run_make', lambda *_: None)
+    run_command = build_appimage.run_command
+    monkeypatch.setattr(build_appimage, 'run_command',
+                        lambda command, **kwargs: '' if command.startswith('make') else run_command(command, **kwargs))
+    sqlite_config = {'version': '3.36.0', 'source_path': tarballs[0]}
+    app_dir = tmp_path.joinpath('AppDir')
+    keys = {}
+    for _profile in ('stock', 'general', 'analytics'):
+        tree = build_appimage.BuildTree(tmp_path.joinpath('src', _profile))
+        keys[_profile] = build_appimage.configure_sqlite(sqlite_config, app_dir, tree=tree, profile=_profile)
+
+    assert configured[0] == './configure --prefix=/usr/local/sqlite3'
+    assert configured[1] == ('./configure --prefix=/usr/local/sqlite3 CFLAGS="-O2 -DSQLITE_ENABLE_FTS5 '
+                             '-DSQLITE_DEFAULT_WAL_SYNCHRONOUS=1 -DSQLITE_THREADSAFE=1"')
+    assert '-O3' in configured[2] and '-DSQLITE_DEFAULT_MMAP_SIZE=268435456' in configured[2]
+    for _profile, _command in zip(keys, configured):
+        assert keys[_profile] == build_appimage.get_cache_key(tarballs[0], _command, app_dir)
+    assert len(set(keys.values())) == 3
+    manifest = json.loads(app_dir.joinpath(build_appimage.MANIFEST_PATH).read_text())
+    assert manifest['sqlite']['profile'] == 'analytics'
+    assert 'ENABLE_STAT4' in manifest['sqlite']['compile_options']
+    with raises(build_appimage.AppImageError, match='Unknown sqlite profile'):
+        build_appimage.configure_sqlite(sqlite_config, app_dir, profile='fastest')
@@ -0,0 +1,49 @@
+import sys
+from pathlib import Path
+
+from pytest import fixture
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+import check_python_releases  # noqa: E402
+
+TAGS = [
+    ['v3.11.0rc1', 'v3.10.2', 'v3.10.1'],
+    ['v3.10.0', 'v3.9.10', 'v3.9.9'],
+    ['v3.9.0b1', 'v3.8.12'],
+]
+
+
+@fixture
+def tags_uri(httpserver):
+    endpoint = '/repos/python/cpython/tags'
+    last = httpserver.url_for(endpoint) + f'?per_page=3&page={len(TAGS)}'
+    for _page, _tags in enumerate(TAGS, start=1):
+        query = {'per_page': '3', 'page': str(_page)}
+        etag = f'"page-{_page}"'
+        httpserver.expect_request(endpoint, query_string=query, headers={'If-None-Match': etag}) \
+            .respond_with_data('', status=304)
+        httpserver.expect_request(endpoint, query_string=query) \
+            .respond_with_json([{'name': _tag} for _tag in _tags],
+                               headers={'ETag': etag, 'Link': f'<{last}>; rel="last"'})
+    return httpserver.url_for(endpoint)
+
+
+def test_get_versions_fetches_every_page(tags_uri, tmp_path):
+    tags = check_python_releases.get_versions(tags_uri, per_page=3, cache_file=tmp_path.joinpath('tags.json'))
+    assert tags == [_tag for _page in TAGS for _tag in _page]
+
+
+def test_get_versions_revalidates_cache(tags_uri, httpserver, tmp_path):
+    cache_file = tmp_path.joinpath('tags.json')
+    first = check_python_releases.get_versions(tags_uri, per_page=3, cache_file=cache_file)
+    second = check_python_releases.get_versions(tags_uri, per_page=3, cache_file=cache_file)
+    assert first == second
+    conditional = [_request for _request, _response in httpserver.log if _response.status_code == 304]
+    assert len(conditional) == len(TAGS)
+
+
+def test_get_latest_versions():
+    tags = [_tag for _page in TAGS for _tag in _page]
+    latest = check_python_releases.get_latest_versions([8, 9, 10, 11], tags)
+    assert latest == {8: '3.8.12', 9: '3.9.10', 10: '3.10.2', 11: None}
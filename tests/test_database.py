@@ -5,6 +5,15 @@ from contextlib import contextmanager
 from pytest import fixture
 
 DATA = ('Frodo Baggins', 33, '3f6i')
+# Options PRAGMA compile_options reports for each sqlite profile of build-appimage.py.
+PROFILE_OPTIONS = {
+    'stock': set(),
+    'general': {'ENABLE_FTS5', 'DEFAULT_WAL_SYNCHRONOUS=1', 'THREADSAFE=1'},
+    'analytics': {'ENABLE_FTS5', 'ENABLE_STAT4', 'DEFAULT_WAL_SYNCHRONOUS=1', 'THREADSAFE=1',
+                  'DEFAULT_CACHE_SIZE=-65536', 'DEFAULT_MMAP_SIZE=268435456'},
+}
+# Options a stock build may report too, depending on sqlite's configure defaults.
+STOCK_OPTIONS = {'ENABLE_FTS5', 'THREADSAFE=1'}
 
 
 @contextmanager
@@ -41,6 +50,19 @@ def test_version(database):
     assert data[1] == '3.35.1'
 
 
+def test_compile_options(database, build_manifest):
+    profile = build_manifest['sqlite']['profile']
+    database.execute('PRAGMA compile_options')
+    options = {_row[0] for _row in database.fetchall()}
+    assert set(build_manifest['sqlite']['compile_options']) == PROFILE_OPTIONS[profile]
+    assert PROFILE_OPTIONS[profile] <= options
+    # Options stock sqlite never reports are only set by the profiles that ask for them.
+    assert not (PROFILE_OPTIONS['analytics'] - PROFILE_OPTIONS[profile] - STOCK_OPTIONS) & options
+    if profile == 'analytics':
+        database.execute('PRAGMA cache_size')
+        assert database.fetchone()[0] == -65536
+
+
 def test_read(database):
     database.execute('SELECT * FROM shirelings')
     data = database.fetchone()
@@ -49,6 +71,6 @@ def test_read(database):
     assert isinstance(data[1], int)
 
 
-def test_sqlite_tests_work(host):
+def test_sqlite_tests_work(host, regrtest):
     cmd = host.run(f'{sys.executable} -m test test_sqlite')
     assert cmd.succeeded
@@ -1,6 +1,7 @@
 import ssl
 import subprocess
 import sys
+import sysconfig
 
 
 def test_python_can_import(host):
@@ -21,12 +22,12 @@ def test_ssl_certificate():
     assert context.load_verify_locations('./resources/cert.pem') is None
 
 
-def test_ssl_tests_work(host):
+def test_ssl_tests_work(host, regrtest):
     cmd = host.run(f'{sys.executable} -m test test_ssl')
     assert cmd.succeeded
 
 
-def test_curses_tests_work(host):
+def test_curses_tests_work(host, regrtest):
     cmd = host.run(f'{sys.executable} -m test -ucurses test_curses')
     assert cmd.succeeded
 
@@ -35,3 +36,10 @@ def test_subprocess_can_run():
     output = subprocess.run(['ls'], capture_output=True)
     assert isinstance(output, subprocess.CompletedProcess)
     assert output.returncode == 0
+
+
+def test_build_profile_matches_interpreter(build_manifest):
+    profile = build_manifest['python']['profile']
+    assert hasattr(sys, 'gettotalrefcount') == (profile == 'debug')
+    for flag in build_manifest['python']['configure_flags']:
+        assert flag in sysconfig.get_config_var('CONFIG_ARGS')